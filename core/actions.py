@@ -1,10 +1,11 @@
 import abc
+import os
 import sqlite3
+import uuid
 from pathlib import Path
-from typing import Any, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-import records
-import sqlalchemy
+import tiktoken
 
 from utils.common import ToolResponse
 from utils.enumeration import EXEC_CODE, OBS_TYPE
@@ -12,6 +13,26 @@ from utils.types import TableRepType
 from utils.utils import *
 
 from .sandbox import Sandbox
+from .sync import dataframe_records
+
+# hard cap on the rows a query returns, larger results are truncated
+MAX_QUERY_ROWS = 10000
+FETCH_BATCH_SIZE = 1000
+# default token budget of a query result shown to the model
+QUERY_TOKEN_BUDGET = 2000
+N_EXAMPLE_ROWS = 3
+
+
+# queries from the model can only read the database
+READ_ONLY_ACTIONS = (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE)
+# pragmas describing the tables, which can be used to inspect the schema
+READ_ONLY_PRAGMAS = ("table_info", "table_xinfo", "table_list", "index_list", "index_info", "foreign_key_list")
+
+
+def read_only_authorizer(action: int, arg1: Optional[str], *args) -> int:
+    if action in READ_ONLY_ACTIONS or (action == sqlite3.SQLITE_PRAGMA and arg1.lower() in READ_ONLY_PRAGMAS):
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
 
 
 class ActionExecutor(abc.ABC):
@@ -52,26 +73,60 @@ class PythonInterpreter(ActionExecutor):
 
 
 class SheetSelector(ActionExecutor):
-    def __init__(self, db_path: Path, table_rep: TableRepType, add_row_number: bool, lower_case: bool) -> None:
+    def __init__(
+        self,
+        db_path: Path,
+        table_rep: TableRepType,
+        add_row_number: bool,
+        lower_case: bool,
+        max_rows: int = MAX_QUERY_ROWS,
+        token_budget: Optional[int] = None,
+        encoding: Optional["tiktoken.Encoding"] = None,
+    ) -> None:
         super().__init__()
         self.db_path = db_path
         self.table_rep = table_rep
-        self.sqlite_conn = sqlite3.connect(self.db_path)
-
-        self.db = records.Database(f"sqlite:///{self.db_path}")
-        self.records_conn = self.db.get_connection()
+        self.max_rows = max_rows
+        # the query results given to the model are rendered within `token_budget` tokens (see `render_rows`)
+        self.token_budget = token_budget
+        self.encoding = encoding
+        if token_budget is not None and encoding is None:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+        # each selector works on a private in-memory copy of the database: concurrent sessions do not collide and
+        # the updates do not touch the disk. The selector may be used from another thread than the one creating it
+        # (see `Session.run_async`).
+        memory_uri = f"file:sheet_selector_{uuid.uuid4().hex}?mode=memory&cache=shared"
+        self.sqlite_conn = sqlite3.connect(memory_uri, uri=True, check_same_thread=False)
+        source_conn = sqlite3.connect(Path(self.db_path).resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            source_conn.backup(self.sqlite_conn)
+        finally:
+            source_conn.close()
+        # queries from the model go through a second connection to the same database, which can only read
+        self.query_conn = sqlite3.connect(memory_uri, uri=True, check_same_thread=False)
+        self.query_conn.set_authorizer(read_only_authorizer)
         self.add_row_number = add_row_number
         self.lower_case = lower_case
         if add_row_number:
             self.row_number_column = "Row Number"
             if lower_case:
                 self.row_number_column = self.row_number_column.lower()
+        # schema, example rows and description of each table, computed once per version of the table; the version
+        # changes when the table is rewritten
+        self.table_versions: Dict[str, int] = {}
+        self.table_cache: Dict[Tuple[str, str], Tuple[int, Any]] = {}
 
     def get_name(self) -> str:
         return "Sheet Selector"
 
+    def get_table_names(self) -> List[str]:
+        cursor = self.query_conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite~_%' ESCAPE '~' ORDER BY name"
+        )
+        return [row[0] for row in cursor.fetchall()]
+
     def get_tables(self, table_names: Optional[List[str]] = None):
-        table_names = table_names if table_names is not None else self.db.get_table_names()
+        table_names = table_names if table_names is not None else self.get_table_names()
         return [self.get_table(table_name) for table_name in table_names]
 
     def get_table(self, table_name: str):
@@ -80,29 +135,171 @@ class SheetSelector(ActionExecutor):
         return tb
 
     def get_create_table_sqls(self, table_names: Optional[List[str]] = None):
-        table_names = table_names if table_names is not None else self.db.get_table_names()
+        table_names = table_names if table_names is not None else self.get_table_names()
         return [self.get_create_table_sql(table_name) for table_name in table_names]
 
     def get_create_table_sql(self, table_name: str):
-        table_create_query_sql = 'SELECT sql FROM sqlite_master WHERE type="table" AND name = "{}"'.format(table_name)
-        _, res = self.execute_query(table_create_query_sql, convert=False)
-        return res
+        def query():
+            table_create_query_sql = 'SELECT sql FROM sqlite_master WHERE type="table" AND name = "{}"'.format(
+                table_name
+            )
+            _, res = self.execute_query(table_create_query_sql, convert=False)
+            return res
+
+        return self.cached(table_name, "schema", query)
 
     def get_example_rows_list(self, table_names: Optional[List[str]] = None):
-        table_names = table_names if table_names is not None else self.db.get_table_names()
+        table_names = table_names if table_names is not None else self.get_table_names()
         return [self.get_example_rows(table_name) for table_name in table_names]
 
     def get_example_rows(self, table_name: str):
-        _, tb = self.execute_query("SELECT * FROM `{}` LIMIT 3".format(table_name))
-        return tb
+        def query():
+            _, tb = self.execute_query("SELECT * FROM `{}` LIMIT {}".format(table_name, N_EXAMPLE_ROWS))
+            return tb
+
+        return self.cached(table_name, "example_rows", query)
+
+    def get_table_descs(self, table_names: List[str]) -> List[str]:
+        return [self.get_table_desc(table_name) for table_name in table_names]
+
+    def get_table_desc(self, table_name: str) -> str:
+        """Schema and example rows of a table, as given to the informer."""
+
+        def describe():
+            sql, rows = self.get_create_table_sql(table_name), self.get_example_rows(table_name)
+            return (
+                f'Table schema of "{table_name}":\n{sql}\n/*\n{N_EXAMPLE_ROWS} example rows:\n'
+                f'SELECT * FROM "{table_name}" LIMIT {N_EXAMPLE_ROWS};\n{rows}\n*/'
+            )
+
+        return self.cached(table_name, "desc", describe)
+
+    def cached(self, table_name: str, kind: str, compute):
+        version = self.table_versions.get(table_name, 0)
+        entry = self.table_cache.get((table_name, kind))
+        if entry is None or entry[0] != version:
+            entry = (version, compute())
+            self.table_cache[(table_name, kind)] = entry
+        return entry[1]
+
+    def invalidate(self, table_name: str):
+        self.table_versions[table_name] = self.table_versions.get(table_name, 0) + 1
 
     def update_table(self, table_name: str, tb_new: pd.DataFrame):
         if self.add_row_number:  # add row number column
             row_number_col = "row number" if self.lower_case else "Row Number"
             tb_new.insert(0, row_number_col, range(1, 1 + len(tb_new)))
-        tb_new.to_sql(table_name, self.sqlite_conn, if_exists="replace", index=False)
+        try:
+            tb_new.to_sql(table_name, self.sqlite_conn, if_exists="replace", index=False)
+        finally:
+            self.invalidate(table_name)
+
+    def update_rows(self, table_name: str, tb_new: pd.DataFrame, row_ranges: List[Tuple[int, int]], n_rows_old: int):
+        """Rewrite only the given [start, stop) data row ranges of a table previously written by `update_table`.
+        Rows are addressed by rowid, which follows the insertion order of `to_sql`."""
+        n_cols = len(tb_new.columns) + (1 if self.add_row_number else 0)
+        columns = list(tb_new.columns)
+        if self.add_row_number:
+            columns.insert(0, "row number" if self.lower_case else "Row Number")
+        quoted_table = '"{}"'.format(str(table_name).replace('"', '""'))
+        assignments = ", ".join('"{}" = ?'.format(str(col).replace('"', '""')) for col in columns)
+        update_sql = f"UPDATE {quoted_table} SET {assignments} WHERE rowid = ?"
+        insert_sql = f"INSERT INTO {quoted_table} VALUES ({', '.join(['?'] * n_cols)})"
+
+        # only the first rows are shown as examples, the schema does not change
+        if len(tb_new) < N_EXAMPLE_ROWS or any(start < N_EXAMPLE_ROWS for start, _ in row_ranges):
+            self.invalidate(table_name)
+        with self.sqlite_conn:
+            if len(tb_new) < n_rows_old:
+                self.sqlite_conn.execute(f"DELETE FROM {quoted_table} WHERE rowid > ?", (len(tb_new),))
+            for start, stop in row_ranges:
+                records = dataframe_records(tb_new.iloc[start:stop])
+                if self.add_row_number:
+                    records = [(start + i + 1,) + record for i, record in enumerate(records)]
+                n_update = max(0, min(stop, n_rows_old) - start)
+                self.sqlite_conn.executemany(
+                    update_sql, [record + (start + i + 1,) for i, record in enumerate(records[:n_update])]
+                )
+                self.sqlite_conn.executemany(insert_sql, records[n_update:])
 
-    def execute_query(self, sql_query: str, convert=True) -> Tuple[EXEC_CODE, Any]:
+    def dump(self, path: Path):
+        """Write the current database to `path`, for inspection."""
+        os.makedirs(Path(path).parent, exist_ok=True)
+        target_conn = sqlite3.connect(path)
+        try:
+            self.sqlite_conn.backup(target_conn)
+        finally:
+            target_conn.close()
+
+    def fetch_rows(self, sql_query: str) -> Tuple[List[str], List[tuple], bool]:
+        """Run a query and return its header, at most `max_rows` rows and whether the result was truncated."""
+        cursor = self.query_conn.cursor()
+        try:
+            cursor.execute(sql_query)
+            headers = [column[0] for column in cursor.description or []]
+            rows = []
+            while len(rows) < self.max_rows:
+                batch = cursor.fetchmany(min(FETCH_BATCH_SIZE, self.max_rows - len(rows)))
+                if not batch:
+                    break
+                rows.extend(batch)
+            truncated = len(rows) >= self.max_rows and cursor.fetchone() is not None
+        finally:
+            cursor.close()
+        return headers, rows, truncated
+
+    def convert_rows(self, headers: List[str], rows: List[tuple], first_row_number: int = 1) -> str:
+        tb = {"header": headers, "rows": rows}
+        if self.table_rep == "json":  # the rows are numbered by position
+            return sqltb2json(tb, self.add_row_number, self.lower_case, first_row_number)
+        return eval(f"sqltb2{self.table_rep}(tb, {self.add_row_number}, {self.lower_case})")
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def render_sample(self, headers: List[str], rows: List[tuple], n_head: int, n_tail: int, note: str) -> str:
+        parts = [self.convert_rows(headers, rows[:n_head])] if n_head > 0 else []
+        if n_tail > 0:
+            parts.append(f"... ({len(rows) - n_head - n_tail} rows omitted) ...")
+            parts.append(self.convert_rows(headers, rows[-n_tail:], len(rows) - n_tail + 1))
+        return "\n".join(parts + [note])
+
+    def render_rows(self, sql_query: str, headers: List[str], rows: List[tuple], truncated: bool, token_budget: int):
+        """Render the query result within `token_budget` tokens. A larger result is reduced to its first and last
+        rows, with the total row count and the query giving the next rows."""
+        # every row takes at least one token, so a longer result cannot fit
+        if len(rows) <= token_budget:
+            tb = self.convert_rows(headers, rows)
+            if self.count_tokens(tb) <= token_budget:
+                return tb
+
+        query = sql_query.strip().rstrip(";").strip()
+
+        def sample(n_rows: int) -> str:
+            # a truncated result has no last rows to show
+            n_head = n_rows if truncated else (n_rows + 1) // 2
+            n_tail = n_rows - n_head
+            total = f"more than {self.max_rows}" if truncated else str(len(rows))
+            shown = f"the first {n_head}" + (f" and the last {n_tail}" if n_tail > 0 else "")
+            note = (
+                f"(The result has {total} rows, only {shown} are shown. To see the next rows, run the query again as "
+                f"`SELECT * FROM ({query}) LIMIT {max(n_rows, 1)} OFFSET {n_head};`.)"
+            )
+            return self.render_sample(headers, rows, n_head, n_tail, note)
+
+        # the largest sample within the budget
+        lo, hi = 0, min(len(rows) - 1, token_budget)
+        best = sample(0)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            text = sample(mid)
+            if self.count_tokens(text) <= token_budget:
+                lo, best = mid, text
+            else:
+                hi = mid - 1
+        return best
+
+    def execute_query(self, sql_query: str, convert=True, token_budget: Optional[int] = None) -> Tuple[EXEC_CODE, Any]:
         if "select" not in sql_query.lower():
             return EXEC_CODE.FAIL, "Only support SELECT query."
         if self.add_row_number:
@@ -130,37 +327,35 @@ class SheetSelector(ActionExecutor):
             sql_query_new = sql_query
 
         try:
-            out = self.records_conn.query(sql_query_new)
-        except sqlite3.OperationalError as e:
-            return EXEC_CODE.FAIL, "Error occurs:\n" + str(e)
-        except sqlalchemy.exc.OperationalError as e:  # type: ignore
-            return EXEC_CODE.FAIL, "Error occurs:\n" + str(e)
+            headers, rows, truncated = self.fetch_rows(sql_query_new)
+        except sqlite3.Error as e:
+            # same report as the driver errors wrapped by SQLAlchemy, the executed query helps the model
+            return EXEC_CODE.FAIL, f"Error occurs:\n({type(e).__module__}.{type(e).__name__}) {e}\n[SQL: {sql_query_new}]"
         except Exception as e:
             return EXEC_CODE.FAIL, "Error occurs:\n" + str(e)
 
-        results: List = out.all()
-        if results is None or len(results) == 0:  # no query results
+        if len(rows) == 0:  # no query results
             return EXEC_CODE.SUCCESS, None
 
-        unmerged_results = []
-        headers = out.dataset.headers
-        for i in range(len(results)):
-            unmerged_results.append(results[i].values())
-        tb = {"header": headers, "rows": unmerged_results}
+        tb = {"header": headers, "rows": rows}
 
         if "sqlite_master" in sql_query.lower() or sql_query.lower().startswith("select count"):
             return EXEC_CODE.SUCCESS, tb["rows"][0][0]
 
         if convert:
             try:
-                tb = eval(f"sqltb2{self.table_rep}(tb, {self.add_row_number}, {self.lower_case})")
+                if token_budget is not None:
+                    return EXEC_CODE.SUCCESS, self.render_rows(sql_query_new, headers, rows, truncated, token_budget)
+                tb = self.convert_rows(headers, rows)
             except Exception as e:
                 return EXEC_CODE.FAIL, e
+            if truncated:
+                tb += f"\n(The result has more than {self.max_rows} rows, only the first {self.max_rows} are shown.)"
 
         return EXEC_CODE.SUCCESS, tb
 
     def utilize(self, action_input: str) -> ToolResponse:
-        exec_code, obs = self.execute_query(action_input)
+        exec_code, obs = self.execute_query(action_input, token_budget=self.token_budget)
         if obs is None:
             obs = "Executed successfully, the query result is empty."
             obs_type = OBS_TYPE.NULL
@@ -1,45 +1,185 @@
 import abc
+import asyncio
+import contextlib
 import json
-import time
-from typing import Optional
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
 
 # ...existing code...
+import httpx
 import openai
 # ...existing code...
 
 from prompt.informer import load_few_shot as load_informer_few_shot
 from prompt.planner import load_few_shot as load_agent_few_shot
-from utils.enumeration import MODEL_TYPE, ROLE
-from utils.exceptions import TokenLimitError
-from utils.utils import get_model_token_limit, num_tokens_from_messages
+from utils.enumeration import CACHE_MODE, MODEL_TYPE, ROLE
+from utils.exceptions import CacheMissError, TokenLimitError
+from utils.utils import ResponseCutoff, TokenLedger, count_message_tokens, get_encoding, get_model_token_limit
+
+from .memory import ConversationMemory
+from .retry import RetryPolicy, get_circuit_breaker, get_request_slots
+
+
+GOOGLE_MODELS = [MODEL_TYPE.GEMINI_PRO, MODEL_TYPE.GEMMA_7B_IT, MODEL_TYPE.GEMMA_3_12B, MODEL_TYPE.GEMMA_3_27B]
+
+# async clients are bound to the event loop they were created in, so they are shared per loop and endpoint
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[tuple, openai.AsyncOpenAI]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_client(api_key: str, base_url: str, max_connections: int = 100) -> openai.AsyncOpenAI:
+    """Return the client of the running event loop for the endpoint, all the sessions of the loop share its
+    connection pool."""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (api_key, base_url)
+    if key not in clients:
+        http_client = openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        # retries are handled by `RetryPolicy`
+        clients[key] = openai.AsyncOpenAI(
+            api_key=api_key, base_url=base_url, timeout=60, max_retries=0, http_client=http_client
+        )
+    return clients[key]
+
+
+async def close_async_clients():
+    """Close the clients of the running event loop and their connections, before the loop ends."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+
+def parse_chat_completion(response) -> Tuple[str, Optional[str], Optional[int]]:
+    prompt_tokens = response.usage.prompt_tokens if response.usage is not None else None
+    return response.choices[0].message.role, response.choices[0].message.content, prompt_tokens
+
+
+def read_chunk(chunk, cutoff: ResponseCutoff, role: str) -> Tuple[str, bool]:
+    """Add a streamed chunk to the response, return the role and whether the rest can be dropped."""
+    if not chunk.choices:
+        return role, False
+    delta = chunk.choices[0].delta
+    return delta.role or role, cutoff.feed(delta.content or "")
+
+
+class PromptPrefix:
+    """The static part of every query: the system prompt followed by the few-shot examples.
+    Prefixes are built once per process and shared by all the assistants using the same prompt."""
+
+    _cache: Dict[tuple, "PromptPrefix"] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, messages: Tuple[dict, ...]) -> None:
+        self.messages = messages
+        self.token_counts: Dict[str, int] = {}
+
+    @classmethod
+    def get(cls, key: tuple, build) -> "PromptPrefix":
+        with cls._lock:
+            if key not in cls._cache:
+                cls._cache[key] = PromptPrefix(tuple(build()))
+            return cls._cache[key]
+
+    def num_tokens(self, model_type: MODEL_TYPE) -> int:
+        encoding = get_encoding(model_type)
+        if encoding.name not in self.token_counts:
+            self.token_counts[encoding.name] = sum(count_message_tokens(msg, encoding) for msg in self.messages)
+        return self.token_counts[encoding.name]
 
 
 class Assistant(abc.ABC):
-    def __init__(self, sys_prompt, model_type: MODEL_TYPE, few_shot, api_config: dict) -> None:
+    # whether a streamed response is stopped once it holds a complete planner action (see `ResponseCutoff`)
+    cut_off_stream = True
+
+    def __init__(self, sys_prompt, model_type: MODEL_TYPE, few_shot, api_config: dict, llm_cache=None) -> None:
         super().__init__()
         self.sys_prompt = sys_prompt
         self.model_type = model_type
         self.few_shot = few_shot
+        self.llm_cache = llm_cache
         self.msg_history = []
+        self.ledger = TokenLedger(model_type)
+        self.token_limit = self.get_token_limit()
+        self.memory = ConversationMemory.from_config(api_config.get("memory"), self.token_limit)
 
-        if model_type.name.startswith("OLLAMA"):
-            self.client = openai.OpenAI(api_key="ollama", base_url=api_config["api_base"], timeout=60)
-        else:
-            self.client = openai.OpenAI(api_key=api_config["api_key"], base_url=api_config["api_base"], timeout=60)
+        self.api_key = "ollama" if model_type.name.startswith("OLLAMA") else api_config["api_key"]
+        self.api_base = api_config["api_base"]
+        self.max_connections = api_config.get("max_connections", 100)
+        self.client = openai.OpenAI(api_key=self.api_key, base_url=self.api_base, timeout=60, max_retries=0)
+        # stream the completions and stop them once the action is complete
+        self.stream = api_config.get("stream", False)
+        self.retry_policy = RetryPolicy.from_config(api_config.get("retry"))
+        self.circuit_breaker = get_circuit_breaker(self.api_base, api_config.get("circuit_breaker"))
+        # requests in flight to the endpoint, counted across processes; the waits between retries do not hold a slot,
+        # and the wait for a slot is bounded by the retry deadline
+        self.request_slots = get_request_slots(
+            self.api_base, api_config.get("max_concurrent_requests"), api_config.get("request_slot_dir")
+        )
 
     @abc.abstractmethod
     def construct_few_shot_query(self, query: list):
         raise NotImplementedError()
 
+    def few_shot_key(self) -> tuple:
+        """Identifies the few-shot examples used by `construct_few_shot_query`."""
+        return ()
+
+    def get_prefix(self) -> PromptPrefix:
+        key = (type(self).__name__, self.sys_prompt, self.few_shot_key() if self.few_shot else None)
+
+        def build():
+            query = [{"role": ROLE.SYSTEM.value, "content": self.sys_prompt}]
+            if self.few_shot:
+                query = self.construct_few_shot_query(query)
+            return query
+
+        return PromptPrefix.get(key, build)
+
     def ask(self, prompt: str) -> Optional[str]:
-        self.msg_history.append({"role": ROLE.USER.value, "content": prompt})
-        query = [{"role": ROLE.SYSTEM.value, "content": self.sys_prompt}]
-        if self.few_shot:
-            query = self.construct_few_shot_query(query)
+        query, cache_key, response = self.prepare_query(prompt)
+        if response is None:
+            response = self.request(query)
+        return self.record_response(cache_key, response)
 
-        query.extend(self.msg_history)
+    async def ask_async(self, prompt: str) -> Optional[str]:
+        """Same as `ask`, but the model is queried without blocking the event loop."""
+        query, cache_key, response = self.prepare_query(prompt)
+        if response is None:
+            response = await self.request_async(query)
+        return self.record_response(cache_key, response)
 
-        num_tokens = num_tokens_from_messages(query, self.model_type)
+    def prepare_query(self, prompt: str) -> Tuple[list, Optional[str], Optional[tuple]]:
+        """Append the prompt to the history and build the query. In replay mode the cached response is returned
+        too, otherwise it is None."""
+        message = {"role": ROLE.USER.value, "content": prompt}
+        self.msg_history.append(message)
+        self.ledger.append(message)
+        prefix = self.get_prefix()
+        if self.ledger.prefix_tokens is None:
+            self.ledger.prefix_tokens = prefix.num_tokens(self.model_type)
+
+        self.memory.compact(self.msg_history, self.ledger)
+        query = list(prefix.messages)
+        query.extend(self.memory.view(self.msg_history))
+
+        num_tokens = self.ledger.estimate()
+        if num_tokens >= self.token_limit:
+            raise TokenLimitError(num_tokens, self.token_limit)
+
+        cache_key = None
+        response = None
+        if self.llm_cache is not None:
+            cache_key = self.llm_cache.make_key(self.model_type, query)
+            if self.llm_cache.mode == CACHE_MODE.REPLAY:
+                response = self.llm_cache.get(cache_key)
+                if response is None:
+                    raise CacheMissError(cache_key)
+        return query, cache_key, response
+
+    def get_token_limit(self) -> int:
         token_limit = get_model_token_limit(self.model_type)
         if token_limit is None:
             # Per i modelli Ollama, potremmo non avere un limite predefinito,
@@ -48,51 +188,104 @@ class Assistant(abc.ABC):
                 token_limit = 8192  # Un valore di default ragionevole
             else:
                 raise NotImplementedError(f"Model type {self.model_type} is not supported.")
-        if num_tokens >= token_limit:
-            raise TokenLimitError(num_tokens, token_limit)
+        return token_limit
 
-        while True:
-            try:
-                if self.model_type in [MODEL_TYPE.GEMINI_PRO, MODEL_TYPE.GEMMA_7B_IT, MODEL_TYPE.GEMMA_3_12B, MODEL_TYPE.GEMMA_3_27B]:
-                    # Gemini/Google uses a different format for messages; only 'user' and 'model' roles are allowed.
-                    gemini_query = []
-                    for msg in query:
-                        # Force all non-assistant roles to 'user'
-                        role = "model" if msg["role"] == "assistant" else "user"
-                        gemini_query.append({"role": role, "parts": [msg["content"]]})
-
-                    response = self.client.generate_content(gemini_query)
-                    gpt_message_content = response.text
-                    gpt_message_role = "assistant"  # Gemini API returns role as 'model'
-                else:
-                    response = self.client.chat.completions.create(
-                        model=self.model_type.value,
-                        messages=query,  # type: ignore
-                        # temperature=0.2,
-                    )
-                    gpt_message_content = response.choices[0].message.content
-                    gpt_message_role = response.choices[0].message.role
-                break
-            except (
-                openai.APIConnectionError,
-                openai.APITimeoutError,
-                openai.APIError,
-                openai.RateLimitError,
-                openai.InternalServerError,
-                # ...existing code...
-                Exception,
-            ) as e:
-                print(f"{e}\nRetrying...")
-                time.sleep(5)
-
-        self.msg_history.append({"role": gpt_message_role, "content": gpt_message_content})
+    def record_response(self, cache_key: Optional[str], response: tuple) -> Optional[str]:
+        gpt_message_role, gpt_message_content, prompt_tokens = response
+        if self.llm_cache is not None and self.llm_cache.mode == CACHE_MODE.RECORD:
+            self.llm_cache.put(cache_key, self.model_type, gpt_message_role, gpt_message_content, prompt_tokens)
+        self.ledger.calibrate(prompt_tokens)
+
+        message = {"role": gpt_message_role, "content": gpt_message_content}
+        self.msg_history.append(message)
+        self.ledger.append(message)
 
         return gpt_message_content
 
+    def request(self, query: list) -> Tuple[str, Optional[str], Optional[int]]:
+        """Send the query to the model, return (role, content, prompt tokens reported by the server)."""
+
+        def send(timeout: float):
+            slot = self.request_slots.hold(self.retry_policy.deadline) if self.request_slots is not None else None
+            with slot or contextlib.nullcontext():
+                return self.send(query, timeout)
+
+        return self.retry_policy.run(send, self.circuit_breaker)
+
+    def send(self, query: list, timeout: float) -> Tuple[str, Optional[str], Optional[int]]:
+        if self.model_type in GOOGLE_MODELS:
+            # Gemini/Google uses a different format for messages; only 'user' and 'model' roles are allowed.
+            gemini_query = []
+            for msg in query:
+                # Force all non-assistant roles to 'user'
+                role = "model" if msg["role"] == "assistant" else "user"
+                gemini_query.append({"role": role, "parts": [msg["content"]]})
+
+            response = self.client.generate_content(gemini_query)
+            return "assistant", response.text, None  # Gemini API returns role as 'model'
+
+        response = self.client.chat.completions.create(
+            model=self.model_type.value,
+            messages=query,  # type: ignore
+            timeout=timeout,
+            stream=self.stream,
+            # temperature=0.2,
+        )
+        if not self.stream:
+            return parse_chat_completion(response)
+
+        cutoff = ResponseCutoff()
+        role = ROLE.ASSISTANT.value
+        try:
+            for chunk in response:
+                role, done = read_chunk(chunk, cutoff, role)
+                if done and self.cut_off_stream:
+                    break
+        finally:
+            response.close()  # closing the connection stops the generation
+        return role, cutoff.text, None
+
+    async def request_async(self, query: list) -> Tuple[str, Optional[str], Optional[int]]:
+        if self.model_type in GOOGLE_MODELS:
+            # no async client for these models
+            return await asyncio.get_running_loop().run_in_executor(None, self.request, query)
+
+        client = get_async_client(self.api_key, self.api_base, self.max_connections)
+
+        async def send(timeout: float):
+            slot = self.request_slots.hold_async(self.retry_policy.deadline) if self.request_slots is not None else None
+            async with slot or contextlib.nullcontext():
+                return await send_query(timeout)
+
+        async def send_query(timeout: float):
+            response = await client.chat.completions.create(
+                model=self.model_type.value,
+                messages=query,  # type: ignore
+                timeout=timeout,
+                stream=self.stream,
+            )
+            if not self.stream:
+                return parse_chat_completion(response)
+
+            cutoff = ResponseCutoff()
+            role = ROLE.ASSISTANT.value
+            try:
+                async for chunk in response:
+                    role, done = read_chunk(chunk, cutoff, role)
+                    if done and self.cut_off_stream:
+                        break
+            finally:
+                await response.close()
+            return role, cutoff.text, None
+
+        return await self.retry_policy.run_async(send, self.circuit_breaker)
+
 
 class Planner(Assistant):
-    def __init__(self, sys_prompt, model_type: MODEL_TYPE, few_shot, table_rep, with_informer, api_config) -> None:
-        super().__init__(sys_prompt, model_type, few_shot, api_config)
+    def __init__(
+        self, sys_prompt, model_type: MODEL_TYPE, few_shot, table_rep, with_informer, api_config, llm_cache=None
+    ) -> None:
+        super().__init__(sys_prompt, model_type, few_shot, api_config, llm_cache)
         self.table_rep = table_rep
         self.with_informer = with_informer
 
@@ -102,17 +295,20 @@ class Planner(Assistant):
             query.extend(shot)
         return query
 
+    def few_shot_key(self) -> tuple:
+        return (self.with_informer,)
+
     def save(self, save_dir):
-        query = [{"role": ROLE.SYSTEM.value, "content": self.sys_prompt}]
-        if self.few_shot:
-            query = self.construct_few_shot_query(query)
         with open(save_dir / "history_agent.json", "w", encoding="utf-8") as f:
-            json.dump(query + self.msg_history, f)
+            json.dump(list(self.get_prefix().messages) + self.msg_history, f)
 
 
 class Informer(Assistant):
-    def __init__(self, sys_prompt, model_type: MODEL_TYPE, few_shot, api_config) -> None:
-        super().__init__(sys_prompt, model_type, few_shot, api_config)
+    # the informer does not answer with tool actions, its responses are always read in full
+    cut_off_stream = False
+
+    def __init__(self, sys_prompt, model_type: MODEL_TYPE, few_shot, api_config, llm_cache=None) -> None:
+        super().__init__(sys_prompt, model_type, few_shot, api_config, llm_cache)
 
     def construct_few_shot_query(self, query: list):
         few_shot_examples = load_informer_few_shot()
@@ -121,8 +317,5 @@ class Informer(Assistant):
         return query
 
     def save(self, save_dir):
-        query = [{"role": ROLE.SYSTEM.value, "content": self.sys_prompt}]
-        if self.few_shot:
-            query = self.construct_few_shot_query(query)
         with open(save_dir / "history_informer.json", "w", encoding="utf-8") as f:
-            json.dump(query + self.msg_history, f)
+            json.dump(list(self.get_prefix().messages) + self.msg_history, f)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Optional, Tuple
+
+from utils.enumeration import CACHE_MODE, MODEL_TYPE
+
+DEFAULT_CACHE_PATH = Path("llm_cache") / "responses.db"
+
+
+class LLMCache:
+    """On-disk store of model responses keyed by model and a canonical hash of the message list.
+
+    - passthrough: the cache is not used.
+    - record: every query is sent to the model and the response is stored.
+    - replay: responses are only read from the store, a missing entry raises `CacheMissError`.
+    """
+
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH, mode: CACHE_MODE = CACHE_MODE.RECORD) -> None:
+        self.path = Path(path)
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if self.mode == CACHE_MODE.REPLAY and not self.path.exists():
+            raise FileNotFoundError(f"LLM cache {self.path} not found, run in record mode first.")
+        os.makedirs(self.path.parent, exist_ok=True)
+        # several benchmark processes may share the store
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, role TEXT, content BLOB, prompt_tokens INTEGER, created REAL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model_type: MODEL_TYPE, messages: list) -> str:
+        canonical = json.dumps(
+            {"model": model_type.value, "messages": messages},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, Optional[str], Optional[int]]]:
+        """Return (role, content, prompt_tokens) of the stored response, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT role, content, prompt_tokens FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        role, content, prompt_tokens = row
+        content = zlib.decompress(content).decode("utf-8") if content is not None else None
+        return role, content, prompt_tokens
+
+    def put(
+        self,
+        key: str,
+        model_type: MODEL_TYPE,
+        role: str,
+        content: Optional[str],
+        prompt_tokens: Optional[int] = None,
+    ):
+        blob = zlib.compress(content.encode("utf-8")) if content is not None else None
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_type.value, role, blob, prompt_tokens, time.time()),
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def build_llm_cache(config_api: dict, mode: Optional[str] = None, path: Optional[str] = None) -> Optional[LLMCache]:
+    """Create the cache from the `llm_cache` section of the api config; `mode` and `path` override it."""
+    config = config_api.get("llm_cache") or {}
+    mode = CACHE_MODE(mode or config.get("mode", CACHE_MODE.PASSTHROUGH.value))
+    if mode == CACHE_MODE.PASSTHROUGH:
+        return None
+    return LLMCache(Path(path or config.get("path", DEFAULT_CACHE_PATH)), mode)
@@ -0,0 +1,84 @@
+import re
+from typing import Dict, List, Optional
+
+from utils.enumeration import ROLE
+from utils.utils import TokenLedger, count_message_tokens
+
+SHEET_STATE_PATTERN = r"^Sheet state: .*$"
+
+
+def compact_observation(content: str, max_chars: int) -> str:
+    """Short form of an old observation: the sheet state it reports is outdated by the later observations,
+    and long outputs keep only their beginning and end."""
+    content = re.sub(SHEET_STATE_PATTERN, "Sheet state: (outdated, omitted)", content, flags=re.MULTILINE)
+    if len(content) > max_chars:
+        head, tail = content[: max_chars // 2], content[-(max_chars // 2) :]
+        content = f"{head}\n[... {len(content) - len(head) - len(tail)} characters omitted ...]\n{tail}"
+    return content
+
+
+def shorten_message(msg: dict, level: int, max_chars: int) -> Optional[dict]:
+    """Level 1 compacts observations, level 2 leaves only a trace of the turn (the first line of the reply)."""
+    if level == 1:
+        if msg["role"] != ROLE.USER.value:
+            return None
+        content = compact_observation(msg["content"], max_chars)
+    elif msg["role"] == ROLE.USER.value:
+        content = "(observation omitted)"
+    else:
+        first_line = (msg["content"] or "").strip().split("\n", 1)[0][:max_chars]
+        content = f"{first_line}\n(rest of the reply omitted)"
+    if content == msg["content"]:
+        return None
+    return {"role": msg["role"], "content": content}
+
+
+class ConversationMemory:
+    """Decides what part of the history is sent to the model. When the query exceeds `budget` tokens, old turns
+    are shortened, oldest first, until it is back under `low_watermark * budget`: observations are compacted
+    first, then the oldest turns are reduced to a trace. The first message (the task) and the last
+    `keep_recent` messages are always sent verbatim. Shortened messages stay shortened, so the sent history
+    only changes when the budget is exceeded, and the system prompt and few-shot prefix are never touched."""
+
+    def __init__(
+        self,
+        budget: Optional[int] = None,
+        keep_recent: int = 4,
+        max_observation_chars: int = 600,
+        low_watermark: float = 0.75,
+    ) -> None:
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.max_observation_chars = max_observation_chars
+        self.low_watermark = low_watermark
+        self.shortened: Dict[int, dict] = {}
+        self.levels: Dict[int, int] = {}
+
+    @classmethod
+    def from_config(cls, config: Optional[dict], token_limit: Optional[int]) -> "ConversationMemory":
+        config = dict(config or {})
+        if "budget" not in config and token_limit is not None:
+            config["budget"] = int(token_limit * 0.75)
+        return cls(**config)
+
+    def view(self, history: List[dict]) -> List[dict]:
+        return [self.shortened.get(idx, msg) for idx, msg in enumerate(history)]
+
+    def compact(self, history: List[dict], ledger: TokenLedger):
+        """Shorten old turns if the query is over budget, keeping the ledger in sync with the view."""
+        if self.budget is None or ledger.estimate() <= self.budget:
+            return
+
+        target = self.budget * self.low_watermark
+        for level in (1, 2):
+            for idx in range(1, len(history) - self.keep_recent):
+                if self.levels.get(idx, 0) >= level:
+                    continue
+                self.levels[idx] = level
+                msg = shorten_message(history[idx], level, self.max_observation_chars)
+                if msg is None:
+                    continue
+                self.shortened[idx] = msg
+                ledger.replace(idx, count_message_tokens(msg, ledger.encoding))
+                if ledger.estimate() <= target:
+                    return
@@ -0,0 +1,142 @@
+import contextlib
+import io
+import sys
+import threading
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional, TextIO
+
+# streams capturing the output of the code running in the current context (thread or task), if any
+_captured_stdout: ContextVar[Optional[TextIO]] = ContextVar("captured_stdout", default=None)
+_captured_stderr: ContextVar[Optional[TextIO]] = ContextVar("captured_stderr", default=None)
+_install_lock = threading.Lock()
+
+
+class OutputProxy:
+    """Stands for sys.stdout or sys.stderr: writes go to the stream captured in the current context, or to the
+    stream the proxy replaced. The process-wide streams are never swapped, so sandboxes can run in different
+    threads at the same time, and the rest of the process keeps writing where it was writing before."""
+
+    def __init__(self, captured: ContextVar, stream: TextIO) -> None:
+        self.captured = captured
+        self.stream = stream
+
+    def target(self) -> TextIO:
+        stream = self.captured.get()
+        return stream if stream is not None else self.stream
+
+    def write(self, text: str) -> int:
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.target(), name)
+
+
+def install_output_proxies():
+    """Put the proxies in place, wrapping the current streams. Called before each capture, since the caller may
+    have replaced the streams (e.g. with `contextlib.redirect_stdout`) in the meantime."""
+    with _install_lock:
+        if not isinstance(sys.stdout, OutputProxy):
+            sys.stdout = OutputProxy(_captured_stdout, sys.stdout)
+        if not isinstance(sys.stderr, OutputProxy):
+            sys.stderr = OutputProxy(_captured_stderr, sys.stderr)
+
+
+@contextlib.contextmanager
+def capture_output(stdout: TextIO, stderr: TextIO):
+    """Send what the code run in the block prints, in the current thread or task, to `stdout` and `stderr`.
+    Threads started by that code have their own context and print to the original streams."""
+    install_output_proxies()
+    stdout_token = _captured_stdout.set(stdout)
+    stderr_token = _captured_stderr.set(stderr)
+    try:
+        yield
+    finally:
+        _captured_stderr.reset(stderr_token)
+        _captured_stdout.reset(stdout_token)
+
+
+class CappedBuffer(io.TextIOBase):
+    """Text stream keeping only the first `head_chars` and the last `tail_chars` characters written, so that
+    its memory is bounded whatever the code prints. The text in between is counted and, if `spill_path` is
+    given, the whole output is written there as soon as it does not fit."""
+
+    # what code checking the stream it prints to (e.g. for colors or unicode support) expects of `sys.stdout`
+    encoding = "utf-8"
+    errors = "strict"
+
+    def __init__(self, head_chars: int, tail_chars: int, spill_path: Optional[Path] = None) -> None:
+        super().__init__()
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.spill_path = spill_path
+        self.spill: Optional[TextIO] = None
+        self.head = []
+        self.head_len = 0
+        # chunks holding at least the last `tail_chars` characters, compacted when they hold twice as many
+        self.tail = []
+        self.tail_len = 0
+        self.n_chars = 0
+        self.n_omitted_lines = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        n_written = len(text)
+        self.n_chars += n_written
+        if self.spill is not None:
+            self.spill.write(text)
+        elif self.spill_path is not None and self.n_chars > self.head_chars + self.tail_chars:
+            # nothing has been dropped yet: what is kept plus `text` is the whole output
+            self.spill = open(self.spill_path, "w", encoding="utf-8")
+            self.spill.write("".join(self.head) + "".join(self.tail) + text)
+
+        if self.head_len < self.head_chars:
+            part = text[: self.head_chars - self.head_len]
+            self.head.append(part)
+            self.head_len += len(part)
+            text = text[len(part) :]
+        if text:
+            self.tail.append(text)
+            self.tail_len += len(text)
+            if self.tail_len > 2 * self.tail_chars:
+                self.compact_tail()
+        return n_written
+
+    def compact_tail(self):
+        tail = "".join(self.tail)
+        n_dropped = len(tail) - self.tail_chars
+        self.n_omitted_lines += tail.count("\n", 0, n_dropped)
+        self.tail = [tail[n_dropped:]]
+        self.tail_len = self.tail_chars
+
+    def flush(self):
+        if self.spill is not None and not self.spill.closed:
+            self.spill.flush()
+
+    def close(self):
+        """Close the spill file, what was kept can still be read with `getvalue`."""
+        if self.spill is not None:
+            self.spill.close()
+        super().close()
+
+    def getvalue(self) -> str:
+        if self.tail_len > self.tail_chars:
+            self.compact_tail()
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        n_omitted = self.n_chars - len(head) - len(tail)
+        if n_omitted == 0:
+            return head + tail
+        note = f"{n_omitted} characters ({self.n_omitted_lines} lines) omitted"
+        if self.spill_path is not None:
+            note += f", full output in {self.spill_path}"
+        return f"{head}\n... [{note}] ...\n{tail}"
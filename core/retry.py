@@ -0,0 +1,260 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import httpx
+import openai
+
+from utils.exceptions import CircuitOpenError, LLMRequestError
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):  # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    # authentication, bad requests, unknown models and programming errors do not go away by retrying
+    return False
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Delay requested by the server with a `Retry-After` header, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Shared by all the requests to an endpoint: after `failure_threshold` consecutive failures the endpoint
+    is considered down and requests fail immediately for `reset_timeout` seconds, then a single trial request
+    decides whether it is healthy again."""
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, reset_timeout: float = 60.0) -> None:
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self.trial_running:
+                raise CircuitOpenError(self.endpoint, max(retry_in, 0.0))
+            self.trial_running = True  # half-open: let this request through
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release(self):
+        """The request ended without telling anything about the endpoint health (fatal error, cancellation)."""
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint: str, config: Optional[dict] = None) -> CircuitBreaker:
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint, **(config or {}))
+        return _breakers[endpoint]
+
+
+class RequestSlots:
+    """At most `limit` requests in flight to an endpoint, across all the processes sharing `slot_dir`: a request
+    holds the lock of one of `limit` files in the directory. The lock goes away with its process, even if killed."""
+
+    def __init__(self, slot_dir: Path, limit: int, poll_interval: float = 0.05) -> None:
+        self.slot_dir = Path(slot_dir)
+        self.limit = limit
+        self.poll_interval = poll_interval
+        os.makedirs(self.slot_dir, exist_ok=True)
+
+    def try_acquire(self) -> Optional[int]:
+        """The descriptor of a free slot, now locked, or None if all the slots are taken."""
+        for i in range(self.limit):
+            fd = os.open(self.slot_dir / f"slot_{i}", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def release(self, fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def timed_out(self, timeout: Optional[float]) -> TimeoutError:
+        return TimeoutError(f"No request slot in {self.slot_dir} was freed within {timeout:g}s.")
+
+    @contextlib.contextmanager
+    def hold(self, timeout: Optional[float] = None):
+        """Hold a slot for the block, waiting at most `timeout` seconds for one to be free."""
+        start = time.monotonic()
+        fd = self.try_acquire()
+        while fd is None:
+            if timeout is not None and time.monotonic() - start >= timeout:
+                raise self.timed_out(timeout)
+            time.sleep(self.poll_interval)
+            fd = self.try_acquire()
+        try:
+            yield
+        finally:
+            self.release(fd)
+
+    @contextlib.asynccontextmanager
+    async def hold_async(self, timeout: Optional[float] = None):
+        start = time.monotonic()
+        fd = self.try_acquire()
+        while fd is None:
+            if timeout is not None and time.monotonic() - start >= timeout:
+                raise self.timed_out(timeout)
+            await asyncio.sleep(self.poll_interval)
+            fd = self.try_acquire()
+        try:
+            yield
+        finally:
+            self.release(fd)
+
+
+def get_request_slots(endpoint: str, limit: Optional[int], slot_dir: Optional[str] = None) -> Optional[RequestSlots]:
+    """Slots shared by the processes sending requests to `endpoint`, None if there is no limit (or no file locks)."""
+    if not limit or fcntl is None:
+        return None
+    if slot_dir is None:
+        endpoint_key = hashlib.sha1(endpoint.encode("utf-8")).hexdigest()[:16]
+        slot_dir = Path(tempfile.gettempdir()) / "sheetagent_request_slots" / endpoint_key
+    return RequestSlots(Path(slot_dir), limit)
+
+
+class RetryPolicy:
+    """Retries a model request on transient errors, with exponential backoff and full jitter, up to
+    `max_attempts` attempts and `deadline` seconds overall. Each attempt gets the remaining time as timeout,
+    at most `request_timeout`."""
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        deadline: float = 600.0,
+        request_timeout: float = 60.0,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.request_timeout = request_timeout
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]) -> "RetryPolicy":
+        return cls(**(config or {}))
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        server_delay = retry_after(error)
+        if server_delay is not None:
+            delay = max(delay, min(server_delay, self.max_delay))
+        return delay
+
+    def next_delay(self, attempt: int, error: Exception, start: float, breaker: Optional[CircuitBreaker]) -> float:
+        """Delay before the next attempt after `error`, raise if the request must not be retried."""
+        if not is_retryable(error):
+            if breaker is not None:
+                breaker.release()
+            raise LLMRequestError(f"Request failed with a non-retryable error: {error!r}") from error
+        if breaker is not None:
+            breaker.record_failure()
+        if attempt + 1 >= self.max_attempts:
+            raise LLMRequestError(f"Request failed after {attempt + 1} attempts: {error!r}") from error
+        delay = self.backoff(attempt, error)
+        if time.monotonic() - start + delay >= self.deadline:
+            raise LLMRequestError(f"Request deadline of {self.deadline}s exceeded: {error!r}") from error
+        return delay
+
+    def timeout(self, start: float) -> float:
+        return max(min(self.request_timeout, self.deadline - (time.monotonic() - start)), 1.0)
+
+    def run(self, send, breaker: Optional[CircuitBreaker] = None):
+        """Call `send(timeout)` until it succeeds."""
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                result = send(self.timeout(start))
+            except BaseException as e:
+                if not isinstance(e, Exception):  # interrupted
+                    if breaker is not None:
+                        breaker.release()
+                    raise
+                delay = self.next_delay(attempt, e, start, breaker)
+                print(f"{e}\nRetrying in {delay:.1f}s...")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    async def run_async(self, send, breaker: Optional[CircuitBreaker] = None):
+        """Same as `run`, `send(timeout)` being a coroutine function."""
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                result = await send(self.timeout(start))
+            except BaseException as e:
+                if not isinstance(e, Exception):  # cancelled or interrupted
+                    if breaker is not None:
+                        breaker.release()
+                    raise
+                delay = self.next_delay(attempt, e, start, breaker)
+                print(f"{e}\nRetrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
@@ -1,18 +1,146 @@
 import code
+import contextlib
+import copy
 import io
-import sys
+import signal
+import threading
+import types
+import warnings
 from pathlib import Path
+from typing import List, Optional
 
-from utils.common import SandboxResponse
+import openpyxl
+
+from utils.common import SandboxResponse, SheetState
 from utils.enumeration import *
+from utils.workbook import take_workbook
+
+from .output import CappedBuffer, capture_output
+from .sync import TableChange, WorkbookSync
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# successful steps between two checkpoints: checkpoints are not free (the workbook is serialized), and a rollback
+# replays the steps run since the last one
+CHECKPOINT_INTERVAL = 5
+# characters of the output (and of the error) of a step that are kept, half from the start and half from the end
+MAX_OUTPUT_CHARS = 8000
+
+
+class StepLimitExceeded(BaseException):
+    """Raised in the agent code when a step exceeds its time limits. Not an `Exception`, so that the agent code
+    cannot swallow it with `except Exception`."""
+
+
+def report_step_limit(error: str) -> str:
+    """The traceback of a step stopped by `Sandbox.step_limits` ends in the signal handler: drop that frame and
+    report the limit as a TimeoutError."""
+    marker = f"{StepLimitExceeded.__module__}.{StepLimitExceeded.__qualname__}: "
+    if marker not in error:
+        return error
+    traceback, message = error.rsplit(marker, 1)
+    traceback = traceback.split(f'  File "{__file__}"', 1)[0]
+    return f"{traceback}TimeoutError: {message}"
+
+
+def set_memory_limit(memory_limit: Optional[int]):
+    """Limit the address space of the whole process to `memory_limit` MB: allocations beyond it raise MemoryError."""
+    if memory_limit is None or resource is None:
+        return
+    limit = memory_limit * 1024 * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+# memo key of the workbook reloaded by `Sandbox.rollback`, see `WorkbookRef`
+RELOADED_WORKBOOK = "reloaded_workbook"
+
+
+class WorkbookRef:
+    """Stands for the workbook, one of its sheets or one of its cells inside a checkpoint: deep-copying it with
+    the memo of `Sandbox.rollback` gives the matching object of the reloaded workbook."""
+
+    __slots__ = ("title", "row", "column")
+
+    def __init__(self, title: Optional[str] = None, row: Optional[int] = None, column: Optional[int] = None) -> None:
+        self.title = title
+        self.row = row
+        self.column = column
+
+    def __deepcopy__(self, memo):
+        workbook = memo[RELOADED_WORKBOOK]
+        if self.title is None:
+            return workbook
+        sheet = workbook[self.title]
+        return sheet if self.row is None else sheet.cell(self.row, self.column)
+
+
+class LayeredMemo(dict):
+    """Deep-copy memo on top of another one, which is read but never written: a failed copy is dropped with its
+    layer, without copying the memo below."""
+
+    def __init__(self, base: dict) -> None:
+        super().__init__()
+        self.base = base
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.base.get(key, default)
+
+    def __getitem__(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.base[key]
+
+
+def serialize_workbook(workbook: openpyxl.Workbook) -> bytes:
+    # openpyxl closes the image streams of a workbook while saving it, so that it could not be saved again:
+    # give every image a fresh stream before and after saving
+    images = [image for sheet in workbook.worksheets for image in getattr(sheet, "_images", [])]
+    images_data = [image._data() for image in images]
+    for image, data in zip(images, images_data):
+        image.ref = io.BytesIO(data)
+
+    buffer = io.BytesIO()
+    try:
+        workbook.save(buffer)
+    finally:
+        for image, data in zip(images, images_data):
+            image.ref = io.BytesIO(data)
+    return buffer.getvalue()
 
 
 class Sandbox:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        cpu_timeout: Optional[float] = None,
+        max_output_chars: Optional[int] = MAX_OUTPUT_CHARS,
+    ) -> None:
+        # limits of a single step, in seconds of wall-clock and CPU time
+        self.timeout = timeout
+        self.cpu_timeout = cpu_timeout if resource is not None else None
+        self.max_output_chars = max_output_chars
+        # where the whole output of the steps exceeding `max_output_chars` is written, if anywhere
+        self.spill_dir: Optional[Path] = None
         self.interpreter = code.InteractiveInterpreter()
         self.code_history = []
         self.stdout = []
         self.stderr = []
+        # snapshot of the namespace and the workbook taken every `checkpoint_interval` successful steps, with the
+        # length of the code history at that point: errors roll back to it and replay the steps run since
+        self.checkpoint = None
+        self.checkpoint_interval = CHECKPOINT_INTERVAL
+        # structured sheet state, memoized until the next step that may mutate the workbook
+        self.sheet_states: Optional[List[SheetState]] = None
+        # tracks what has already been synced from the workbook to the database
+        self.workbook_sync = WorkbookSync()
         self.import_lib()
 
     def import_lib(self):
@@ -23,11 +151,15 @@ class Sandbox:
         self.step(code_import, dummy=False)
 
     def load_workbook(self, workbook_path):
+        # take the parsed workbook from the shared cache if it is there, instead of parsing the file again
+        self.interpreter.locals["wb_path"] = str(workbook_path)
+        self.interpreter.locals["workbook"] = take_workbook(workbook_path)
+        self.sheet_states = None
 
+        # keep the equivalent code in the history, so that the saved code can be replayed
         code_init = [f'wb_path = r"{workbook_path}"']
         code_init += [f"workbook = openpyxl.load_workbook(wb_path)"]
-
-        self.step("\n".join(code_init), dummy=False)
+        self.code_history.append("\n".join(code_init))
 
     def load_worksheets(self, sheet_vars):
         sheet_names = self.get_existing_sheet_names()
@@ -38,83 +170,217 @@ class Sandbox:
 
         self.step("\n".join(code_init), dummy=False)
 
-    def get_existing_sheet_names(self):
-        code_snippet = "print(workbook.sheetnames)"
-        sheet_names = self.step(code_snippet, dummy=True).msg.splitlines()[-1]
-        sheet_names = eval(sheet_names)
-        return sheet_names
+    def spill_output_to(self, spill_dir: Optional[Path]):
+        if spill_dir is not None:
+            Path(spill_dir).mkdir(parents=True, exist_ok=True)
+        self.spill_dir = spill_dir
+
+    def output_buffer(self, kind: str, dummy: bool):
+        if self.max_output_chars is None:
+            return io.StringIO()
+        spill_path = None
+        if self.spill_dir is not None and not dummy:
+            spill_path = Path(self.spill_dir) / f"step_{len(self.stdout)}_{kind}.txt"
+        head_chars = self.max_output_chars // 2
+        return CappedBuffer(head_chars, self.max_output_chars - head_chars, spill_path)
+
+    def get_workbook(self):
+        return self.interpreter.locals["workbook"]
+
+    def get_existing_sheet_names(self) -> List[str]:
+        return list(self.get_workbook().sheetnames)
+
+    def get_sheet_states(self) -> List[SheetState]:
+        if self.sheet_states is None:
+            workbook = self.get_workbook()
+            self.sheet_states = [self.describe_sheet(workbook[sheet_name]) for sheet_name in workbook.sheetnames]
+        return self.sheet_states
+
+    @staticmethod
+    def describe_sheet(sheet) -> SheetState:
+        max_column, max_row = sheet.max_column, sheet.max_row
+        if max_column == max_row == sheet.min_column == sheet.min_row == 1 and sheet.cell(1, 1).value is None:
+            return SheetState(sheet.title, 0, 0, [], [])
+
+        headers = [cell.value for cell in sheet[1]]
+        if max_row >= 2:
+            data_types = [str(cell.value.__class__) for cell in sheet[2]]
+        else:  # do not index the missing row, it would create new cells
+            data_types = [str(type(None))] * len(headers)
+        return SheetState(sheet.title, max_row, max_column, headers, data_types)
 
     def get_sheet_state(self) -> str:
-        sheet_state = ""
-        sheet_names = self.get_existing_sheet_names()
-        for sheet_name in sheet_names:
-            code_snippet = f"""print(workbook["{sheet_name}"].max_column)
-print(workbook["{sheet_name}"].max_row)
-print(workbook["{sheet_name}"].min_column)
-print(workbook["{sheet_name}"].min_row)
-print(workbook["{sheet_name}"].cell(1, 1).value)"""
-            max_column, max_row, min_column, min_row, first_value = self.step(code_snippet, dummy=True).msg.splitlines()
-            if (max_column == max_row == min_column == min_row == str(1)) and str(first_value) == "None":
-                sheet_desc = 'Sheet "{sheet_name}" is empty. '.format(sheet_name=sheet_name)
-            else:
-                sheet_desc = 'Sheet "{sheet_name}" has {n_rows} rows (Including the header row) and {n_cols} columns ({headers}). '
-                code_snippet = f"""print(workbook["{sheet_name}"].max_column)
-print(workbook["{sheet_name}"].max_row)
-print([cell.value for cell in workbook["{sheet_name}"][1]])
-print([str(cell.value.__class__) for cell in workbook["{sheet_name}"][2]])"""
-
-                n_cols, n_rows, headers, data_types = self.step(code_snippet, dummy=True).msg.splitlines()
-                import datetime
-
-                headers = eval(headers)
-                data_types = eval(data_types)
-
-                headers_str = ", ".join(
-                    [
-                        f'{chr(65 + i)}({i+1}): "{header}" ({data_type})'
-                        for i, (header, data_type) in enumerate(zip(headers, data_types))
-                    ]
-                )
-                sheet_desc = sheet_desc.format(
-                    sheet_name=sheet_name,
-                    n_cols=int(n_cols),
-                    headers=headers_str,
-                    n_rows=int(n_rows),
-                )
-
-            sheet_state += sheet_desc
-
-        return sheet_state
+        return "".join(state.describe() for state in self.get_sheet_states())
+
+    def collect_changes(self) -> List[TableChange]:
+        """Return the sheets (or row ranges) changed since the last call, read from the live workbook."""
+        return self.workbook_sync.collect_changes(self.get_workbook())
+
+    def mark_synced(self):
+        """Take the live workbook as already written to the database, so the next sync only rewrites what changes."""
+        self.workbook_sync.seed(self.get_workbook())
+
+    def forget_synced_table(self, table_name: str):
+        self.workbook_sync.forget(table_name)
 
     def reset(self):
         self.interpreter = code.InteractiveInterpreter()
+        self.checkpoint = None
+        self.sheet_states = None
 
-    def step(self, code_snippet: str, dummy=False) -> SandboxResponse:
-        out_buffer = io.StringIO()
-        err_buffer = io.StringIO()
-        sys.stdout = out_buffer
-        sys.stderr = err_buffer
+    @staticmethod
+    def snapshot_namespace(namespace: dict, memo: Optional[dict] = None) -> dict:
+        """Deep-copy the interpreter namespace, sharing a single memo so aliases between variables are kept.
+
+        Modules, dunder entries and objects that cannot be copied are kept by reference.
+        """
+        memo = LayeredMemo(memo if memo is not None else {})
+        snapshot = {}
+        for name, value in namespace.items():
+            if name.startswith("__") or isinstance(value, types.ModuleType):
+                snapshot[name] = value
+                continue
+            trial_memo = LayeredMemo(memo)  # a failed copy must not leave half-built objects in the shared memo
+            try:
+                snapshot[name] = copy.deepcopy(value, trial_memo)
+                memo.update(trial_memo)
+            except Exception:
+                snapshot[name] = value
+        return snapshot
+
+    def steps_since_checkpoint(self) -> int:
+        return len(self.code_history) - (self.checkpoint[0] if self.checkpoint is not None else 0)
+
+    def save_checkpoint(self):
+        """Checkpoint the state after a successful step: the workbook is serialized with openpyxl itself
+        (its objects do not survive `copy.deepcopy`), the other variables are deep-copied."""
+        namespace = self.interpreter.locals
+        workbook = namespace.get("workbook")
+        if not isinstance(workbook, openpyxl.Workbook):
+            self.checkpoint = (len(self.code_history), None, self.snapshot_namespace(namespace))
+            return
+
+        try:
+            workbook_bytes = serialize_workbook(workbook)
+        except Exception:
+            # the workbook cannot be saved in its current state, fall back to replaying the history
+            self.checkpoint = None
+            return
+
+        # the workbook, its sheets and its cells are replaced by references wherever they appear in the variables
+        # (directly or inside containers), so that they are bound to the reloaded workbook on rollback
+        memo = {id(workbook): WorkbookRef()}
+        for sheet in workbook.worksheets:
+            memo[id(sheet)] = WorkbookRef(sheet.title)
+            for (row, column), cell in sheet._cells.items():
+                memo[id(cell)] = WorkbookRef(sheet.title, row, column)
+        self.checkpoint = (len(self.code_history), workbook_bytes, self.snapshot_namespace(namespace, memo))
+
+    def rollback(self):
+        """Restore the state of the last successful step: restore the last checkpoint and replay the (at most
+        `checkpoint_interval`) successful steps run since, whatever the number of steps before it."""
+        if self.checkpoint is None:
+            # no checkpoint yet, replay the history from the start
+            self.reset()
+            self.replay(self.code_history)
+            return
+
+        history_length, workbook_bytes, variables = self.checkpoint
+        memo = {}
+        if workbook_bytes is not None:
+            memo[RELOADED_WORKBOOK] = openpyxl.load_workbook(io.BytesIO(workbook_bytes))
+        namespace = self.snapshot_namespace(variables, memo)  # keep the checkpoint reusable
+        self.interpreter = code.InteractiveInterpreter(locals=namespace)
+        self.replay(self.code_history[history_length:])
+
+    def replay(self, code_snippets: List[str]):
+        """Run again code that already succeeded, without limits and discarding its output."""
+        discarded = CappedBuffer(0, 0)
+        with capture_output(discarded, discarded):
+            for code_snippet in code_snippets:
+                self.interpreter.runcode(code_snippet)
+
+    @contextlib.contextmanager
+    def step_limits(self):
+        """Stop the code run in the block with `StepLimitExceeded` when it exceeds the time limits. Signals are
+        only delivered to the main thread, elsewhere the code is not limited: a sandbox in a pool worker
+        (see `SandboxPool`) always runs in the main thread of its process."""
+        timeout, cpu_timeout = self.timeout, self.cpu_timeout
+        if timeout is None and cpu_timeout is None:
+            yield
+            return
+        if threading.current_thread() is not threading.main_thread() or not hasattr(signal, "SIGALRM"):
+            warnings.warn("The step limits of the sandbox cannot be enforced here, the code runs without them.")
+            yield
+            return
 
-        self.interpreter.runcode(code_snippet)
+        def on_timeout(signum, frame):
+            raise StepLimitExceeded(f"The code did not finish within the time limit of {timeout}s and was stopped.")
 
-        output = out_buffer.getvalue()
-        error = err_buffer.getvalue()
+        def on_cpu_timeout(signum, frame):
+            raise StepLimitExceeded(f"The code exceeded the CPU time limit of {cpu_timeout}s and was stopped.")
+
+        handlers = {}
+        cpu_limits = None
+        try:
+            if timeout is not None:
+                handlers[signal.SIGALRM] = signal.signal(signal.SIGALRM, on_timeout)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            if cpu_timeout is not None:
+                # the CPU limit counts the time used by the process so far: SIGXCPU is sent when the soft limit
+                # is reached, and again every second until the code stops
+                handlers[signal.SIGXCPU] = signal.signal(signal.SIGXCPU, on_cpu_timeout)
+                cpu_limits = resource.getrlimit(resource.RLIMIT_CPU)
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                soft = int(usage.ru_utime + usage.ru_stime + cpu_timeout) + 1
+                if cpu_limits[1] != resource.RLIM_INFINITY:
+                    soft = min(soft, cpu_limits[1])
+                resource.setrlimit(resource.RLIMIT_CPU, (soft, cpu_limits[1]))
+            yield
+        finally:
+            if timeout is not None:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            if cpu_limits is not None:
+                resource.setrlimit(resource.RLIMIT_CPU, cpu_limits)
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def step(self, code_snippet: str, dummy=False) -> SandboxResponse:
+        out_buffer = self.output_buffer("stdout", dummy)
+        err_buffer = self.output_buffer("stderr", dummy)
+        try:
+            with capture_output(out_buffer, err_buffer):
+                if dummy:  # replays of code that already succeeded are not limited
+                    self.interpreter.runcode(code_snippet)
+                else:
+                    try:
+                        with self.step_limits():
+                            self.interpreter.runcode(code_snippet)
+                    except StepLimitExceeded as e:  # the limit was hit right after the code ended
+                        err_buffer.write(f"TimeoutError: {e}\n")
+
+            output = out_buffer.getvalue()
+            error = err_buffer.getvalue()
+        finally:
+            out_buffer.close()
+            err_buffer.close()
+        error = report_step_limit(error)
 
         if not dummy:
+            self.sheet_states = None
             if error == "":
                 self.code_history.append(code_snippet)
             self.stdout.append(output)
             self.stderr.append(error)
 
-        sys.stdout = sys.__stdout__
-        sys.stderr = sys.__stderr__
-
         if error != "":  # error caught
             # to clear error context
-            self.reset()
-            self.step("\n".join(self.code_history), dummy=True)
+            self.rollback()
             return SandboxResponse(EXEC_CODE.FAIL, error)
 
+        if not dummy and self.steps_since_checkpoint() >= self.checkpoint_interval:
+            self.save_checkpoint()
+
         return SandboxResponse(EXEC_CODE.SUCCESS, output)
 
     def save(self, save_dir: Path, output_name: str = "workbook"):
@@ -127,11 +393,3 @@ print([str(cell.value.__class__) for cell in workbook["{sheet_name}"][2]])"""
 
         with open(save_dir / "errors.txt", "w", encoding="utf-8") as f:
             f.write("\n\n# ============\n".join(self.stderr))
-
-    def save_temp_workbook(self, save_dir: Path, output_name: str = "workbook"):
-        try:
-            result = self.step(f'workbook.close()\nworkbook.save(r"{save_dir / f"{output_name}_temp.xlsx"}")', dummy=True)
-            if result.code == EXEC_CODE.FAIL:
-                print(f"Warning: Failed to save temp workbook: {result.msg}")
-        except Exception as e:
-            print(f"Warning: Exception during temp workbook save: {e}")
\ No newline at end of file
@@ -0,0 +1,277 @@
+import gc
+import multiprocessing
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+from utils.common import SandboxResponse, SheetState
+from utils.enumeration import *
+from utils.exceptions import SandboxCrashError
+
+from .sandbox import MAX_OUTPUT_CHARS, Sandbox, set_memory_limit
+from .sync import TableChange
+
+# request asking a worker to start over with a fresh sandbox
+RESET = "__reset__"
+# a step still running this long after its time limit is stopped by killing its worker: the limits enforced in the
+# worker cannot interrupt some native code
+KILL_GRACE = 10.0
+
+
+def new_sandbox(sandbox_options: dict) -> Sandbox:
+    # figures left open by the previous session would be saved with the next one
+    import matplotlib.pyplot as plt
+
+    plt.close("all")
+    gc.collect()
+    return Sandbox(**sandbox_options)
+
+
+def sandbox_worker(conn, sandbox_options: dict, memory_limit: Optional[int]):
+    """Entry point of a worker process: serves the calls of one session at a time on its sandbox. Building the
+    first sandbox imports the libraries of `Sandbox.import_lib`, later sandboxes find them already imported."""
+    set_memory_limit(memory_limit)
+    sandbox = new_sandbox(sandbox_options)
+    conn.send("ready")
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:  # the driver is gone
+            return
+        if request is None:
+            return
+        method, args, kwargs = request
+        try:
+            if method == RESET:
+                sandbox, result = new_sandbox(sandbox_options), None
+            else:
+                result = getattr(sandbox, method)(*args, **kwargs)
+        except Exception as e:
+            reply = (False, e)
+        else:
+            reply = (True, result)
+        try:
+            conn.send(reply)
+        except Exception as e:  # the result or the exception cannot be pickled
+            conn.send((False, RuntimeError(f"Sandbox.{method} returned an object that cannot be sent back: {e!r}")))
+
+
+class SandboxWorker:
+    """A worker process and the pipe to it. The process starts importing the libraries right away, calls wait
+    until it is ready."""
+
+    def __init__(self, context, sandbox_options: dict, memory_limit: Optional[int] = None) -> None:
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=sandbox_worker, args=(child_conn, sandbox_options, memory_limit), daemon=True
+        )
+        self.process.start()
+        child_conn.close()  # so that the pipe breaks if the worker dies
+        self.ready = False
+        self.n_sessions = 0
+
+    def call(self, method: str, *args, **kwargs):
+        return self.request(method, args, kwargs)
+
+    def request(self, method: str, args: tuple, kwargs: dict, timeout: Optional[float] = None):
+        """Run a method of the sandbox, killing the worker if it does not answer within `timeout` seconds."""
+        try:
+            if not self.ready:
+                self.conn.recv()
+                self.ready = True
+            self.conn.send((method, args, kwargs))
+            if timeout is not None and not self.conn.poll(timeout):
+                self.process.kill()
+                self.process.join()
+                raise SandboxCrashError(self.process.exitcode, f"was stopped after {timeout:.0f}s without finishing")
+            ok, result = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self.process.join(timeout=5)
+            raise SandboxCrashError(self.process.exitcode) from e
+        if not ok:
+            raise result
+        return result
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class SandboxPool:
+    """Worker processes running the sandboxes out of the driver process, with the libraries already imported.
+    A session leases a worker through a `RemoteSandbox` and gives it back at the end, when the worker gets a
+    fresh sandbox for the next session. Agent code crashing its process (or calling `sys.exit`) costs one
+    worker: the session goes on in a new one.
+
+    `timeout` and `cpu_timeout` are the time limits of a step (see `Sandbox.step_limits`), `memory_limit` the
+    address space of a worker in MB and `max_output_chars` the output kept from a step."""
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_sessions_per_worker: int = 20,
+        timeout: Optional[float] = None,
+        cpu_timeout: Optional[float] = None,
+        memory_limit: Optional[int] = None,
+        max_output_chars: Optional[int] = MAX_OUTPUT_CHARS,
+    ) -> None:
+        # spawn, not fork: the driver may run threads and event loops that must not be copied in the workers
+        self.context = multiprocessing.get_context("spawn")
+        self.size = size
+        # workers are restarted after some sessions, to release the memory not given back to the system
+        self.max_sessions_per_worker = max_sessions_per_worker
+        self.sandbox_options = {
+            "timeout": timeout,
+            "cpu_timeout": cpu_timeout,
+            "max_output_chars": max_output_chars,
+        }
+        self.memory_limit = memory_limit
+        limits = [limit for limit in (timeout, cpu_timeout) if limit is not None]
+        self.step_deadline = max(limits) + KILL_GRACE if limits else None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.idle: List[SandboxWorker] = [self.new_worker() for _ in range(size)]
+
+    def __enter__(self) -> "SandboxPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def new_worker(self) -> SandboxWorker:
+        return SandboxWorker(self.context, self.sandbox_options, self.memory_limit)
+
+    def get_worker(self) -> SandboxWorker:
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The sandbox pool is closed.")
+            if self.idle:
+                return self.idle.pop(0)
+        # all the workers are busy: start one more, it is closed on release if it exceeds the pool size
+        return self.new_worker()
+
+    def put_worker(self, worker: SandboxWorker):
+        with self.lock:
+            if not self.closed and len(self.idle) < self.size:
+                self.idle.append(worker)
+                return
+        worker.close()
+
+    def lease(self) -> "RemoteSandbox":
+        worker = self.get_worker()
+        worker.n_sessions += 1
+        return RemoteSandbox(self, worker)
+
+    def release(self, sandbox: "RemoteSandbox"):
+        worker, sandbox.worker = sandbox.worker, None
+        if worker is None:
+            return
+        if worker.n_sessions < self.max_sessions_per_worker:
+            try:
+                worker.call(RESET)
+            except Exception:
+                worker.close()
+            else:
+                self.put_worker(worker)
+                return
+        else:
+            worker.close()
+        # keep the pool warm
+        if not self.closed:
+            self.put_worker(self.new_worker())
+
+    def replace(self, worker: SandboxWorker) -> SandboxWorker:
+        """A new worker for the session of a dead one."""
+        worker.close()
+        new_worker = self.get_worker()
+        new_worker.n_sessions += 1
+        return new_worker
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.close()
+
+
+class RemoteSandbox:
+    """Drives a `Sandbox` living in a pool worker, with the methods used by the session and the tools. The calls
+    building the state of the sandbox are recorded, so that the state can be rebuilt if the worker dies."""
+
+    def __init__(self, pool: SandboxPool, worker: SandboxWorker) -> None:
+        self.pool = pool
+        self.worker: Optional[SandboxWorker] = worker
+        self.journal = []
+
+    def call(self, method: str, *args, **kwargs):
+        try:
+            return self.worker.call(method, *args, **kwargs)
+        except SandboxCrashError:
+            self.recover()
+            raise
+
+    def record(self, method: str, *args, **kwargs):
+        self.journal.append((method, args, kwargs))
+
+    def recover(self):
+        """Move to a new worker and replay the successful calls: the state is the one before the failed call."""
+        self.worker = self.pool.replace(self.worker)
+        for method, args, kwargs in self.journal:
+            self.worker.call(method, *args, **kwargs)
+
+    def load_workbook(self, workbook_path):
+        # the workbook is parsed in the worker, the driver one cannot be sent over
+        self.call("load_workbook", workbook_path)
+        self.record("load_workbook", workbook_path)
+
+    def load_worksheets(self, sheet_vars):
+        self.call("load_worksheets", sheet_vars)
+        self.record("load_worksheets", sheet_vars)
+
+    def spill_output_to(self, spill_dir: Optional[Path]):
+        self.call("spill_output_to", spill_dir)
+        self.record("spill_output_to", spill_dir)
+
+    def get_existing_sheet_names(self) -> List[str]:
+        return self.call("get_existing_sheet_names")
+
+    def get_sheet_states(self) -> List[SheetState]:
+        return self.call("get_sheet_states")
+
+    def get_sheet_state(self) -> str:
+        return self.call("get_sheet_state")
+
+    def collect_changes(self) -> List[TableChange]:
+        return self.call("collect_changes")
+
+    def mark_synced(self):
+        # not recorded: after a recovery the database is no longer the loaded workbook, a full sync is needed
+        self.call("mark_synced")
+
+    def forget_synced_table(self, table_name: str):
+        self.call("forget_synced_table", table_name)
+
+    def step(self, code_snippet: str, dummy=False) -> SandboxResponse:
+        try:
+            timeout = self.pool.step_deadline if not dummy else None
+            response = self.worker.request("step", (code_snippet,), {"dummy": dummy}, timeout)
+        except SandboxCrashError as e:
+            self.recover()
+            return SandboxResponse(EXEC_CODE.FAIL, f"{e}\nThe state before this code was restored.")
+        if not dummy and response.code == EXEC_CODE.SUCCESS:
+            self.record("step", code_snippet, dummy=False)
+        return response
+
+    def save(self, save_dir: Path, output_name: str = "workbook"):
+        self.call("save", save_dir, output_name)
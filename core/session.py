@@ -1,9 +1,11 @@
+import asyncio
 import os
 import re
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
-import pandas as pd
 import yaml
 from colorama import Fore
 
@@ -14,10 +16,11 @@ from utils.common import ToolResponse
 from utils.enumeration import *
 from utils.exceptions import *
 from utils.types import TableRepType
-from utils.utils import parse_action, parse_action_input, parse_think, valid_action
+from utils.utils import get_encoding, parse_action, parse_action_input, parse_think, valid_action
 
-from .actions import AnswerSubmitter, PythonInterpreter, SheetSelector
+from .actions import MAX_QUERY_ROWS, QUERY_TOKEN_BUDGET, AnswerSubmitter, PythonInterpreter, SheetSelector
 from .assistant import Informer, Planner
+from .llm_cache import build_llm_cache
 from .rag import MilvusStore
 from .sandbox import Sandbox
 
@@ -40,6 +43,10 @@ class Session:
         lower_case: bool = True,
         verbose: bool = False,
         table_detection_results: Optional[dict] = None,
+        llm_cache_mode: Optional[str] = None,
+        llm_cache_path: Optional[str] = None,
+        time_limit: Optional[float] = None,
+        max_concurrent_requests: Optional[int] = None,
     ):
         self.problem = problem
         self.output_dir = output_dir
@@ -50,12 +57,16 @@ class Session:
         self.few_shot_informer = few_shot_informer
         self.with_retriever = with_retriever
         self.max_step_planner = 10
+        # seconds after which no new step is started, the session is saved as it is
+        self.time_limit = time_limit
         self.verbose = verbose
         self.api_config = api_config
         self.table_detection_results = table_detection_results
 
         self.sandbox = sandbox
         self.sandbox.load_workbook(self.problem.workbook_path)
+        # the database was built from this workbook: the first sync only rewrites the sheets changed by the agent
+        self.sandbox.mark_synced()
 
         # store the answers
         self.answers = []
@@ -65,6 +76,9 @@ class Session:
         os.makedirs(output_dir, exist_ok=True)
 
         config_api = yaml.load(open(api_config, "r"), Loader=yaml.FullLoader)
+        if max_concurrent_requests is not None:
+            config_api["max_concurrent_requests"] = max_concurrent_requests
+        self.llm_cache = build_llm_cache(config_api, llm_cache_mode, llm_cache_path)
         # construct milvus store
         if self.with_retriever:
             config_milvus = yaml.load(open(milvus_config, "r"), Loader=yaml.FullLoader)
@@ -72,8 +86,15 @@ class Session:
 
         # build tools
         python_interpreter = PythonInterpreter(sandbox=self.sandbox)
+        config_selector = config_api.get("sheet_selector") or {}
         sheet_selector = SheetSelector(
-            db_path=self.problem.db_path, table_rep=self.table_rep, add_row_number=add_row_number, lower_case=lower_case
+            db_path=self.problem.db_path,
+            table_rep=self.table_rep,
+            add_row_number=add_row_number,
+            lower_case=lower_case,
+            max_rows=config_selector.get("max_rows", MAX_QUERY_ROWS),
+            token_budget=config_selector.get("token_budget", QUERY_TOKEN_BUDGET),
+            encoding=get_encoding(self.model_type),
         )
         answer_subumitter = AnswerSubmitter()
         self.tools = {
@@ -90,10 +111,10 @@ class Session:
                 model_type=self.model_type,
                 few_shot=few_shot_informer,
                 api_config=config_api,
+                llm_cache=self.llm_cache,
             )
-            key_info = self.step_informer()
 
-        # construct agent
+        # construct agent, the first informer step and the prompt depending on it come at the start of `run`
         self.system_prompt_planner, self.user_init_prompt_planner = self.construct_planner_prompt(key_info)
         self.planner = Planner(
             self.system_prompt_planner,
@@ -102,6 +123,7 @@ class Session:
             table_rep=table_rep,
             with_informer=self.with_informer,
             api_config=config_api,
+            llm_cache=self.llm_cache,
         )
 
     def construct_planner_prompt(self, key_info: Optional[str]):
@@ -166,16 +188,8 @@ class Session:
             else system_prompt
         )
 
-        db_descs = []
-
         sheet_names = self.sandbox.get_existing_sheet_names()
-        table_create_sqls = self.tools[ACTION.SHEET_SELECTOR.value].get_create_table_sqls(sheet_names)
-        example_rows_list = self.tools[ACTION.SHEET_SELECTOR.value].get_example_rows_list(sheet_names)
-        for _, (sheet_name, sql, rows) in enumerate(zip(sheet_names, table_create_sqls, example_rows_list)):
-            db_descs.append(
-                f'Table schema of "{sheet_name}":\n{sql}\n/*\n3 example rows:\nSELECT * FROM "{sheet_name}" LIMIT 3;\n{rows}\n*/'
-            )
-        db_descs = "\n".join(db_descs)
+        db_descs = "\n".join(self.tools[ACTION.SHEET_SELECTOR.value].get_table_descs(sheet_names))
         thoughts = (
             "Your patner does not have any thoughts at the moment."
             if len(self.thoughts) == 0
@@ -198,19 +212,68 @@ class Session:
         return response
 
     def run(self):
+        steps = self.run_steps()
+        finished, request = resume_steps(steps)
+        while not finished:
+            assistant, prompt = request
+            try:
+                msg = assistant.ask(prompt)
+            except Exception as e:
+                finished, request = resume_steps(steps, error=e)
+            else:
+                finished, request = resume_steps(steps, msg)
+
+    async def run_async(self, executor: Optional[Executor] = None):
+        """Run the session in the event loop: the model is queried asynchronously, while the sandbox and the
+        database work runs in `executor`, which must run one job at a time (by default a new single thread).
+        Many sessions can run concurrently in the same loop. The step limits of a `Sandbox` only work in the main
+        thread, so a sandbox with limits must be leased from a `SandboxPool`, whose workers enforce them."""
+        if isinstance(self.sandbox, Sandbox) and (
+            self.sandbox.timeout is not None or self.sandbox.cpu_timeout is not None
+        ):
+            raise ValueError("Step limits cannot be enforced in the executor thread: use a sandbox from a SandboxPool.")
+        loop = asyncio.get_running_loop()
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session")
+        try:
+            steps = self.run_steps()
+            finished, request = await loop.run_in_executor(executor, resume_steps, steps)
+            while not finished:
+                assistant, prompt = request
+                try:
+                    msg = await assistant.ask_async(prompt)
+                except Exception as e:
+                    finished, request = await loop.run_in_executor(executor, resume_steps, steps, None, e)
+                else:
+                    finished, request = await loop.run_in_executor(executor, resume_steps, steps, msg)
+        finally:
+            if own_executor:
+                executor.shutdown(wait=False)
+
+    def run_steps(self):
+        """The session loop, shared by `run` and `run_async`. It yields (assistant, prompt) whenever a model
+        response is needed and gets back the response, or the exception raised while asking."""
+        deadline = time.monotonic() + self.time_limit if self.time_limit is not None else None
+        if self.with_informer:
+            key_info = yield from self.step_informer()
+            _, self.user_init_prompt_planner = self.construct_planner_prompt(key_info)
+        prompt = self.user_init_prompt_planner
+
         if self.verbose:
             print(Fore.YELLOW + f"System prompt:\n{self.system_prompt_planner}\n")
-        prompt = self.user_init_prompt_planner
-        last_sheet_state = ""
 
         for step in range(self.max_step_planner):
+            if deadline is not None and time.monotonic() > deadline:
+                print(Fore.RED + f"Time limit of {self.time_limit}s exceeded, stopping the session.")
+                break
             if self.verbose:
                 print(Fore.RESET + f"========Round {step + 1}========\n")
                 print(Fore.BLUE + f"Observation:\n{prompt}\n")
             try:
                 # ask
-                msg = self.planner.ask(prompt)
-            except TokenLimitError as e:
+                msg = yield self.planner, prompt
+            except (TokenLimitError, CacheMissError, LLMRequestError) as e:
                 print(Fore.RED + str(e))
                 self.save()
                 break
@@ -266,36 +329,17 @@ class Session:
                     next_step_prompt=PlannerPrompt.NEXT_STEP_FAIL,
                 )
             else:
+                if action == ACTION.PYTHON_INTERPRETER.value:  # update database
+                    self.sync_database()
                 if self.with_informer:
                     self.thoughts.append(think)
-                    key_info = self.step_informer()
+                    key_info = yield from self.step_informer()
                     # key_info = None
                     observation = PlannerPrompt.OBSERVATION_SUCC_WITH_INFORMER
                 else:
                     key_info = None
                     observation = PlannerPrompt.OBSERVATION_SUCC_WO_INFORMER
                 sheet_state = self.sandbox.get_sheet_state()
-                if sheet_state != last_sheet_state:  # update database
-
-                    self.sandbox.save_temp_workbook(self.output_dir)
-                    temp_file_path = self.output_dir / "workbook_temp.xlsx"
-                    
-                    # Check if the temp file exists and is a valid Excel file
-                    if temp_file_path.exists():
-                        try:
-                            wb = pd.read_excel(temp_file_path, sheet_name=None)
-                            for sheet_name, df in wb.items():
-                                # table_name = f"ws_{title2camel(sheet_name)}"
-                                table_name = sheet_name
-                                if not df.empty:
-                                    self.tools["Sheet Selector"].update_table(table_name, df)
-                            last_sheet_state = sheet_state
-                        except Exception as e:
-                            print(f"Warning: Unable to read temp Excel file: {e}")
-                            # Continue without updating the database
-                    else:
-                        print(f"Warning: Temp file {temp_file_path} does not exist")
-
                 if key_info is not None:
                     key_info = f"/*\nPotentially helpful information for your next step:\n{key_info}\n*/"
                 observation = observation.format(
@@ -312,7 +356,21 @@ class Session:
 
         self.save()
 
-    def step_informer(self) -> Optional[str]:
+    def sync_database(self):
+        sheet_selector = self.tools[ACTION.SHEET_SELECTOR.value]
+        for change in self.sandbox.collect_changes():
+            try:
+                if change.row_ranges is None:
+                    sheet_selector.update_table(change.table_name, change.df)
+                else:
+                    sheet_selector.update_rows(change.table_name, change.df, change.row_ranges, change.n_rows_old)
+            except Exception as e:
+                print(f"Warning: Unable to update table {change.table_name}: {e}")
+                # rewrite the whole table at the next sync
+                self.sandbox.forget_synced_table(change.table_name)
+
+    def step_informer(self):
+        """Generator of the informer queries (see `run_steps`), returns the retrieved key information."""
         max_step = 3
 
         # informer
@@ -325,14 +383,7 @@ class Session:
             return match.group(0).strip()
 
         sheet_names = self.sandbox.get_existing_sheet_names()
-        table_create_sqls = self.tools[ACTION.SHEET_SELECTOR.value].get_create_table_sqls(sheet_names)
-        example_rows_list = self.tools[ACTION.SHEET_SELECTOR.value].get_example_rows_list(sheet_names)
-        db_descs = []
-        for _, (sheet_name, sql, rows) in enumerate(zip(sheet_names, table_create_sqls, example_rows_list)):
-            db_descs.append(
-                f'Table schema of "{sheet_name}":\n{sql}\n/*\n3 example rows:\nSELECT * FROM "{sheet_name}" LIMIT 3;\n{rows}\n*/'
-            )
-        db_descs = "\n".join(db_descs)
+        db_descs = "\n".join(self.tools[ACTION.SHEET_SELECTOR.value].get_table_descs(sheet_names))
 
         thoughts = (
             "The spreadsheet agent has not started any subtask yet."
@@ -355,7 +406,7 @@ class Session:
         skip_retrevial = False
         for _ in range(max_step):
             try:
-                msg = self.informer.ask(prompt)
+                msg = yield self.informer, prompt
             except Exception as e:
                 print(e)
                 skip_retrevial = True
@@ -397,7 +448,20 @@ class Session:
 
     def save(self):
         self.sandbox.save(self.output_dir)
+        if self.problem.db_dump_path is not None:
+            self.tools[ACTION.SHEET_SELECTOR.value].dump(self.problem.db_dump_path)
         self.planner.save(self.output_dir)
         if len(self.answers) != 0:
             with open(self.output_dir / "answers.txt", "w", encoding="utf-8") as f:
                 f.write("\n".join(self.answers))
+
+
+def resume_steps(steps, response=None, error: Optional[Exception] = None):
+    """Resume the session loop with the model response (or error) up to its next request.
+    Returns (finished, request); a StopIteration cannot cross an executor future, so it is not propagated."""
+    try:
+        if error is not None:
+            return False, steps.throw(error)
+        return False, steps.send(response)
+    except StopIteration:
+        return True, None
@@ -0,0 +1,109 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils.utils import rows2df, worksheet2rows
+
+
+class TableChange:
+    def __init__(
+        self,
+        table_name: str,
+        df: pd.DataFrame,
+        row_ranges: Optional[List[Tuple[int, int]]] = None,
+        n_rows_old: int = 0,
+    ) -> None:
+        self.table_name = table_name
+        self.df = df
+        # `None` means the whole table must be rewritten, otherwise [start, stop) ranges of changed data rows
+        self.row_ranges = row_ranges
+        self.n_rows_old = n_rows_old
+
+    def __str__(self) -> str:
+        kind = "replace" if self.row_ranges is None else f"rows {self.row_ranges}"
+        return f"Table Change: {self.table_name}, {kind}"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class WorkbookSync:
+    """Keeps fingerprints of what has been written to the database for each sheet of a live workbook,
+    so that only the sheets (or row ranges) that changed since the last sync are rewritten."""
+
+    def __init__(self, max_changed_ratio: float = 0.5) -> None:
+        # above this share of changed rows a full rewrite is cheaper than row updates
+        self.max_changed_ratio = max_changed_ratio
+        self.sheet_hashes: Dict[str, int] = {}
+        self.row_hashes: Dict[str, np.ndarray] = {}
+        self.schemas: Dict[str, tuple] = {}
+
+    def seed(self, workbook):
+        """Take the workbook as already written to the database, e.g. the workbook the database was built from."""
+        self.collect_changes(workbook)
+
+    def forget(self, table_name: str):
+        """Force a full rewrite of the table at the next sync, e.g. after a failed update."""
+        self.sheet_hashes.pop(table_name, None)
+        self.row_hashes.pop(table_name, None)
+        self.schemas.pop(table_name, None)
+
+    def collect_changes(self, workbook) -> List[TableChange]:
+        changes = []
+        for sheet_name in workbook.sheetnames:
+            rows = worksheet2rows(workbook[sheet_name])
+            sheet_hash = hash(tuple(tuple(row) for row in rows))
+            if self.sheet_hashes.get(sheet_name) == sheet_hash:
+                continue
+            self.sheet_hashes[sheet_name] = sheet_hash
+
+            df = rows2df(rows)
+            if df.empty:  # empty sheets are not written to the database
+                continue
+
+            row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+            schema = (tuple(str(col) for col in df.columns), tuple(str(dtype) for dtype in df.dtypes))
+            old_row_hashes = self.row_hashes.get(sheet_name)
+            old_schema = self.schemas.get(sheet_name)
+            self.row_hashes[sheet_name] = row_hashes
+            self.schemas[sheet_name] = schema
+
+            if old_row_hashes is None or old_schema != schema:
+                changes.append(TableChange(sheet_name, df))
+                continue
+
+            row_ranges = changed_row_ranges(old_row_hashes, row_hashes)
+            n_changed = sum(stop - start for start, stop in row_ranges)
+            if n_changed > self.max_changed_ratio * len(row_hashes):
+                changes.append(TableChange(sheet_name, df))
+            elif len(row_ranges) > 0 or len(row_hashes) != len(old_row_hashes):
+                changes.append(TableChange(sheet_name, df, row_ranges, len(old_row_hashes)))
+
+        return changes
+
+
+def changed_row_ranges(old_hashes: np.ndarray, new_hashes: np.ndarray) -> List[Tuple[int, int]]:
+    n_common = min(len(old_hashes), len(new_hashes))
+    changed = np.flatnonzero(old_hashes[:n_common] != new_hashes[:n_common])
+
+    row_ranges = []
+    if len(changed) > 0:
+        # split the changed indices into runs of consecutive rows
+        breaks = np.flatnonzero(np.diff(changed) > 1)
+        starts = np.concatenate(([changed[0]], changed[breaks + 1]))
+        stops = np.concatenate((changed[breaks], [changed[-1]])) + 1
+        row_ranges = [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+    if len(new_hashes) > n_common:  # appended rows
+        row_ranges.append((n_common, len(new_hashes)))
+    return row_ranges
+
+
+def dataframe_records(df: pd.DataFrame) -> List[tuple]:
+    """Convert a dataframe to rows of python values the way `to_sql` binds them (missing values become NULL)."""
+    columns = []
+    for _, series in df.items():
+        values = series.to_numpy(dtype=object, copy=True)
+        values[series.isna().to_numpy()] = None
+        columns.append([value.to_pydatetime() if isinstance(value, pd.Timestamp) else value for value in values])
+    return list(zip(*columns))
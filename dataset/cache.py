@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+
+from utils.utils import rows2df, worksheet2rows
+from utils.workbook import load_workbook, workbook_digest
+
+# bump when the way the database is built changes, so stale cache entries are not reused
+CACHE_VERSION = 2
+ROW_NUMBER_COL = "row number"
+
+
+def create_database(wb_path: Path, db_path: Path, row_number_col: str = ROW_NUMBER_COL) -> None:
+    # same values as `pd.read_excel`, but from the parse shared with the table detector
+    wb = load_workbook(wb_path, data_only=True)
+    conn = sqlite3.connect(db_path)
+
+    for sheet_name in wb.sheetnames:
+        df = rows2df(worksheet2rows(wb[sheet_name]))
+        # add row number
+        df.insert(0, row_number_col, range(1, 1 + len(df)))
+        table_name = sheet_name
+        if not df.empty:
+            df.to_sql(table_name, conn, index=False, if_exists="replace")
+    conn.close()
+
+
+def get_cached_database(workbook_path: Path, cache_dir: Path) -> Path:
+    """Return the path of the prebuilt database of the workbook, building it on a cache miss."""
+    key = workbook_digest(workbook_path, version=CACHE_VERSION, row_number_col=ROW_NUMBER_COL)
+    cached_db_path = cache_dir / f"{key}.db"
+    if not cached_db_path.exists():
+        os.makedirs(cache_dir, exist_ok=True)
+        # build under a private name and publish atomically, concurrent runs may build the same entry
+        tmp_db_path = cache_dir / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            create_database(workbook_path, tmp_db_path)
+            os.replace(tmp_db_path, cached_db_path)
+        finally:
+            if tmp_db_path.exists():
+                tmp_db_path.unlink()
+    return cached_db_path
+
+
+def prewarm(dataset_dir: Path, cache_dir: Path) -> None:
+    files = sorted(dataset_dir.glob("*.xlsx"))
+    for idx, workbook_path in enumerate(files):
+        try:
+            cached_db_path = get_cached_database(workbook_path, cache_dir)
+            print(f"[{idx + 1}/{len(files)}] {workbook_path.name} -> {cached_db_path.name}")
+        except Exception as e:
+            print(f"[{idx + 1}/{len(files)}] {workbook_path.name} failed: {e}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Prebuild the SQLite databases of all the workbooks in a dataset directory.")
+    parser.add_argument("dataset_dir", type=str)
+    parser.add_argument("--cache_dir", type=str, default="./db_path/cache")
+    args = parser.parse_args()
+
+    prewarm(Path(args.dataset_dir), Path(args.cache_dir))
@@ -1,46 +1,51 @@
-import os
-import sqlite3
 from pathlib import Path
 from typing import List, Optional
 
-import openpyxl
-import pandas as pd
+from utils.workbook import sheet_names
+
+from .cache import get_cached_database
 
 
 class SheetProblem:
     def __init__(
-        self, workbook_path: Path, db_path: Path, context: Optional[str], instruction: str, sheet_vars: List[str]
+        self,
+        workbook_path: Path,
+        db_path: Path,
+        context: Optional[str],
+        instruction: str,
+        sheet_vars: List[str],
+        db_dump_path: Optional[Path] = None,
     ) -> None:
         self.workbook_path = workbook_path
+        # initial database of the workbook, only read: each session works on its own in-memory copy
         self.db_path = db_path
         self.context = context
         self.instruction = instruction
         self.sheet_vars = sheet_vars
+        # where the session writes its database at the end, if any
+        self.db_dump_path = db_dump_path
 
 
-def load_problem(workbook_path: Path, db_path: Path, instruction: str) -> SheetProblem:
-    def create_database(wb_path: Path, db_path: Path) -> None:
-        wb = pd.read_excel(wb_path, sheet_name=None)
-        conn = sqlite3.connect(db_path)
-
-        for sheet_name, df in wb.items():
-            # add row number
-            row_number_col = "row number"
-            df.insert(0, row_number_col, range(1, 1 + len(df)))
-            table_name = sheet_name
-            if not df.empty:
-                df.to_sql(table_name, conn, index=False, if_exists="replace")
-
-    os.makedirs(db_path, exist_ok=True)
-    db_file_path = db_path / "database.db"
-    if os.path.exists(db_file_path):
-        os.remove(db_file_path)
-    create_database(workbook_path, db_file_path)
+def load_problem(
+    workbook_path: Path,
+    db_path: Path,
+    instruction: str,
+    cache_dir: Optional[Path] = None,
+    dump_database: bool = False,
+) -> SheetProblem:
+    # the database only depends on the workbook content, reuse the one built by a previous run if any
+    cache_dir = cache_dir if cache_dir is not None else db_path / "cache"
+    db_file_path = get_cached_database(workbook_path, cache_dir)
 
-    workbook = openpyxl.load_workbook(workbook_path)
-    sheet_vars = workbook.sheetnames
+    # the workbook itself is parsed by the sandbox, possibly in a worker process
+    sheet_vars = sheet_names(workbook_path)
 
     context = "The workbook is already loaded as `workbook` using openpyxl, you only need to load the sheet(s) you want to use manually. Besides, the workbook will be automatically saved, so you don't need to save it manually."
     return SheetProblem(
-        workbook_path=workbook_path, db_path=db_file_path, context=context, instruction=instruction, sheet_vars=sheet_vars
+        workbook_path=workbook_path,
+        db_path=db_file_path,
+        context=context,
+        instruction=instruction,
+        sheet_vars=sheet_vars,
+        db_dump_path=db_path / "database.db" if dump_database else None,
     )
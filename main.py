@@ -1,27 +1,124 @@
-from argparse import ArgumentParser
+import asyncio
+import json
+import sys
+from argparse import ArgumentParser, Namespace
 from pathlib import Path
 
-from core.sandbox import Sandbox
+from core.assistant import close_async_clients
+from core.sandbox import MAX_OUTPUT_CHARS, Sandbox
+from core.sandbox_pool import SandboxPool
 from core.session import Session
 from dataset.dataloader import load_problem
-from utils.enumeration import MODEL_TYPE
-from utils.table_detector import analyze_workbook
+from utils.enumeration import CACHE_MODE, MODEL_TYPE
+from utils.table_detector import analyze_workbook, default_cache_dir
 
 
 def main(args):
-    sandbox = Sandbox()
-    problem = load_problem(Path(args.workbook_path), Path(args.db_path), args.instruction)
+    if args.task_file is not None:
+        run_batch(args)
+        return
+    if not args.sandbox_process:
+        # the agent code runs in this process: an address space limit would also cap the driver, its database and
+        # its model clients, so it is only applied in sandbox workers
+        if args.memory_limit is not None:
+            print("--memory_limit only applies with --sandbox_process or --task_file, it is ignored.")
+        sandbox = Sandbox(
+            timeout=args.step_timeout, cpu_timeout=args.step_cpu_timeout, max_output_chars=args.max_output_chars
+        )
+        run(args, sandbox)
+        return
+    # the worker imports the libraries while the problem is loaded
+    with new_pool(args, size=1) as pool:
+        sandbox = pool.lease()
+        try:
+            run(args, sandbox)
+        finally:
+            pool.release(sandbox)
+
+
+def new_pool(args, size: int) -> SandboxPool:
+    return SandboxPool(
+        size=size,
+        timeout=args.step_timeout,
+        cpu_timeout=args.step_cpu_timeout,
+        memory_limit=args.memory_limit,
+        max_output_chars=args.max_output_chars,
+    )
+
+
+def run_batch(args):
+    """Run the tasks of `args.task_file`, `args.workers` at a time, as sessions of one event loop in this process.
+    The agent code runs in a pool of worker processes that stays up for the whole batch, so only the first
+    sessions wait for the libraries to be imported, and the workers enforce the step limits. Each line of the file
+    is a JSON object with the options of a task (e.g. workbook_path, instruction, output_dir, db_path,
+    use_table_detection), the other ones are taken from `args`."""
+    with open(args.task_file, "r", encoding="utf-8") as f:
+        tasks = [json.loads(line) for line in f if line.strip()]
+
+    with new_pool(args, size=args.workers) as pool:
+        n_failed = asyncio.run(run_tasks(args, tasks, pool))
+    if n_failed:
+        sys.exit(f"{n_failed} of {len(tasks)} tasks failed.")
+
+
+async def run_tasks(args, tasks: list, pool: SandboxPool) -> int:
+    loop = asyncio.get_running_loop()
+    running = asyncio.Semaphore(args.workers)
+
+    async def run_task(task: dict):
+        async with running:
+            sandbox = await loop.run_in_executor(None, pool.lease)
+            try:
+                # loading the problem and its database blocks, the steps of the session run in its own thread
+                session = await loop.run_in_executor(None, new_session, Namespace(**{**vars(args), **task}), sandbox)
+                await session.run_async()
+            finally:
+                await loop.run_in_executor(None, pool.release, sandbox)
+
+    async def report(task: dict) -> bool:
+        try:
+            await run_task(task)
+            error = None
+        except Exception as e:
+            error = e
+        status = "OK" if error is None else f"ERROR {error!r}"
+        print(f"[{status}] {task.get('output_dir', '')}", flush=True)
+        return error is not None
+
+    try:
+        return sum(await asyncio.gather(*(report(task) for task in tasks)))
+    finally:
+        await close_async_clients()
+
+
+def run(args, sandbox):
+    new_session(args, sandbox).run()
+
+
+def new_session(args, sandbox) -> Session:
+    if args.spill_output:
+        sandbox.spill_output_to(Path(args.output_dir) / "full_outputs")
+    db_cache_dir = Path(args.db_cache_dir) if args.db_cache_dir is not None else None
+    problem = load_problem(
+        Path(args.workbook_path), Path(args.db_path), args.instruction, cache_dir=db_cache_dir, dump_database=args.dump_db
+    )
     
     table_detection_results = None
     if args.use_table_detection:
         print("Running multi-table detection...")
-        table_detection_results = analyze_workbook(args.workbook_path, verbose=args.verbose)
+        if args.table_detection_cache_dir is not None:
+            detection_cache_dir = Path(args.table_detection_cache_dir)
+        else:
+            detection_cache_dir = default_cache_dir(db_cache_dir or Path(args.db_path) / "cache")
+        table_detection_results = analyze_workbook(
+            args.workbook_path, verbose=args.verbose, cache_dir=detection_cache_dir
+        )
         if args.verbose and table_detection_results:
             import json
             print("Table detection results:")
             print(json.dumps(table_detection_results, indent=2))
 
-    session = Session(
+    return Session(
         problem,
         output_dir=Path(args.output_dir),
         model_type=args.model_type,
@@ -35,8 +132,11 @@ def main(args):
         api_config=args.api_config,
         milvus_config=args.milvus_config,
         table_detection_results=table_detection_results,
+        llm_cache_mode=args.llm_cache,
+        llm_cache_path=args.llm_cache_path,
+        time_limit=args.time_limit,
+        max_concurrent_requests=args.max_concurrent_requests,
     )
-    session.run()
 
 
 if __name__ == "__main__":
@@ -52,6 +152,12 @@ if __name__ == "__main__":
     # parser.add_argument("--workbook_path", type=str, default="example_sheets/BoomerangSales.xlsx")
     parser.add_argument("--workbook_path", type=str, default="example_sheets/BookSales.xlsx")
     parser.add_argument("--db_path", type=str, default="./db_path")
+    parser.add_argument(
+        "--db_cache_dir", type=str, default=None, help="Cache of prebuilt databases (default: <db_path>/cache)."
+    )
+    parser.add_argument(
+        "--dump_db", action="store_true", help="Write the final database of the session to <db_path>/database.db."
+    )
     parser.add_argument("--output_dir", type=str, default="./output")
     parser.add_argument("--few_shot_planner", action="store_true")
     parser.add_argument("--with_informer", action="store_true")
@@ -59,7 +165,48 @@ if __name__ == "__main__":
     parser.add_argument("--with_retriever", action="store_true")
     parser.add_argument("--add_row_number", action="store_true")
     parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--sandbox_process",
+        action="store_true",
+        help="Run the agent code in a separate process, so that a crash of the code does not end the run.",
+    )
+    parser.add_argument(
+        "--task_file",
+        type=str,
+        default=None,
+        help="JSON lines file of tasks to run in this process over a pool of sandbox workers (see `run_batch`).",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Tasks of --task_file run at the same time.")
+    parser.add_argument(
+        "--step_timeout", type=float, default=120.0, help="Wall-clock limit of a code step in seconds (0: none)."
+    )
+    parser.add_argument(
+        "--step_cpu_timeout", type=float, default=120.0, help="CPU time limit of a code step in seconds (0: none)."
+    )
+    parser.add_argument(
+        "--memory_limit", type=int, default=None, help="Address space limit of each sandbox worker in MB (with --sandbox_process or --task_file)."
+    )
+    parser.add_argument(
+        "--max_output_chars",
+        type=int,
+        default=MAX_OUTPUT_CHARS,
+        help="Characters kept from the output of a code step, from its start and its end (0: all).",
+    )
+    parser.add_argument(
+        "--spill_output",
+        action="store_true",
+        help="Write the whole output of the code steps exceeding --max_output_chars to <output_dir>/full_outputs.",
+    )
+    parser.add_argument(
+        "--time_limit", type=float, default=None, help="No new step is started after this many seconds."
+    )
     parser.add_argument("--use_table_detection", action="store_true", help="Enable multi-table detection.")
+    parser.add_argument(
+        "--table_detection_cache_dir",
+        type=str,
+        default=None,
+        help="Cache of table detection results (default: table_detection in the database cache).",
+    )
     parser.add_argument("--table_rep", type=str, choices=["json", "markdown", "dfloader", "html"], default="json")
     parser.add_argument(
         "--model_type",
@@ -70,7 +217,26 @@ if __name__ == "__main__":
     parser.add_argument("--api_provider", type=str, choices=["openai", "google", "ollama"], default="openai")
     parser.add_argument("--api_config", type=str, default=None)
     parser.add_argument("--milvus_config", type=str, default="./config/milvus.yaml")
+    parser.add_argument(
+        "--llm_cache",
+        type=str,
+        choices=[mode.value for mode in CACHE_MODE],
+        default=None,
+        help="Cache of model responses: record, replay or passthrough (default: `llm_cache` in the api config).",
+    )
+    parser.add_argument("--llm_cache_path", type=str, default=None, help="Path of the response cache database.")
+    parser.add_argument(
+        "--max_concurrent_requests",
+        type=int,
+        default=None,
+        help="Requests in flight to the model endpoint, across all the processes (default: "
+        "`max_concurrent_requests` in the api config, no limit).",
+    )
     args = parser.parse_args()
+    # 0 disables a step limit
+    args.step_timeout = args.step_timeout or None
+    args.step_cpu_timeout = args.step_cpu_timeout or None
+    args.max_output_chars = args.max_output_chars or None
 
     if args.api_provider == "google":
         if args.api_config is None:
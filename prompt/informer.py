@@ -1,4 +1,8 @@
 import json
+from functools import lru_cache
+from pathlib import Path
+
+PROMPT_DIR = Path(__file__).parent
 
 
 class InformerPrompt:
@@ -24,9 +28,11 @@ Think: (how do you think)
 Action: (your SQLite statement, e.g., `SELECT * FROM w WHERE age < 18;`, or "pass")"""
 
 
+@lru_cache(maxsize=None)
 def load_few_shot():
+    """The examples are read once per process, callers must not modify them."""
     few_shot = []
-    with open(f"./prompt/informer.jsonl", "r") as f:
+    with open(PROMPT_DIR / "informer.jsonl", "r") as f:
         examples = list(f)
 
     for example in examples:
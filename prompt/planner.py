@@ -1,4 +1,8 @@
 import json
+from functools import lru_cache
+from pathlib import Path
+
+PROMPT_DIR = Path(__file__).parent
 
 
 class PlannerPrompt:
@@ -77,13 +81,15 @@ Below are some referential code fragments from other files, listed in descending
 {next_step_prompt}"""
 
 
+@lru_cache(maxsize=None)
 def load_few_shot(with_informer):
+    """The examples are read once per process, callers must not modify them."""
     few_shot = []
     if with_informer:
-        with open(f"./prompt/planner_with_informer.jsonl", "r") as f:
+        with open(PROMPT_DIR / "planner_with_informer.jsonl", "r") as f:
             examples = list(f)
     else:
-        with open(f"./prompt/planner.jsonl", "r") as f:
+        with open(PROMPT_DIR / "planner.jsonl", "r") as f:
             examples = list(f)
 
     for example in examples:
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
+import json
 import os
 import sys
 import subprocess
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import pandas as pd
 
@@ -12,6 +17,18 @@ BENCHMARK_XLSX_PATH = Path("tasks_tesi.xlsx")     # Path del file benchmark istr
 DATASET_DIR = Path("dataset_90")                  # Cartella dataset di input
 SHEETAGENT_MAIN_PY = Path("main.py")              # Main script SheetAgent
 BASE_OUTPUT_DIR = Path("results1")                # Cartella risultati
+BASE_DB_DIR = Path("db_path")                     # Cartella database SQLite (una sotto-cartella per task)
+DB_CACHE_DIR = BASE_DB_DIR / "cache"              # Cache dei database, condivisa tra task e modalità
+LLM_CACHE_PATH = Path("llm_cache") / "responses.db"  # Cache delle risposte del modello (record/replay)
+
+MAX_WORKERS = 4                 # Numero di task eseguiti in parallelo
+MAX_PER_ENDPOINT = 4            # Massimo numero di richieste in corso sullo stesso endpoint LLM, tra tutti i task
+PROGRESS_INTERVAL = 30          # Secondi tra due aggiornamenti periodici di avanzamento
+
+STEP_TIMEOUT = 120              # Secondi massimi per l'esecuzione di un singolo blocco di codice dell'agente
+MEMORY_LIMIT_MB = 4096          # Memoria massima del processo che esegue il codice dell'agente, in MB
+TASK_TIME_LIMIT = 1200          # Dopo questi secondi il task non inizia nuovi passi e salva i risultati
+TASK_KILL_GRACE = 300           # Secondi concessi oltre TASK_TIME_LIMIT prima di terminare il processo del task
 
 PREPROCESSING_MODES = [
     ("SENZA_preprocessing", False),
@@ -51,7 +68,28 @@ def get_files_to_process(dataset_dir: Path):
     print(f"Trovati {len(files)} file .xlsx nella cartella {dataset_dir}")
     return files
 
-def build_command(workbook_path: Path, instruction: str, output_dir: Path, use_preprocessing: bool):
+def common_options(llm_cache: str = None, max_per_endpoint: int = MAX_PER_ENDPOINT):
+    """ Opzioni di main.py comuni a tutti i task """
+    options = [
+        "--db_cache_dir", str(DB_CACHE_DIR),
+        "--model_type", MODEL_TO_USE,
+        "--api_provider", API_PROVIDER,
+        "--step_timeout", str(STEP_TIMEOUT),
+        "--step_cpu_timeout", str(STEP_TIMEOUT),
+        "--time_limit", str(TASK_TIME_LIMIT),
+        # il limite vale per i processi worker che eseguono il codice dell'agente, non per il driver
+        "--memory_limit", str(MEMORY_LIMIT_MB),
+        # il limite vale per le singole richieste al modello: i task restano in parallelo nel resto del lavoro
+        "--max_concurrent_requests", str(max_per_endpoint),
+        "--verbose"
+    ]
+    if llm_cache is not None:
+        # tutti i task condividono lo stesso archivio di risposte
+        options.extend(["--llm_cache", llm_cache, "--llm_cache_path", str(LLM_CACHE_PATH)])
+    return options
+
+def build_command(workbook_path: Path, instruction: str, output_dir: Path, db_path: Path, use_preprocessing: bool,
+                  llm_cache: str = None, max_per_endpoint: int = MAX_PER_ENDPOINT):
     """ Crea la command line per subprocess """
     cmd = [
         sys.executable,
@@ -59,38 +97,107 @@ def build_command(workbook_path: Path, instruction: str, output_dir: Path, use_p
         "--workbook_path", str(workbook_path),
         "--instruction", instruction,
         "--output_dir", str(output_dir),
-        "--model_type", MODEL_TO_USE,
-        "--api_provider", API_PROVIDER,
-        "--verbose"
-    ]
+        "--db_path", str(db_path),
+        # il codice dell'agente gira in un processo separato, a cui si applica il limite di memoria
+        "--sandbox_process",
+    ] + common_options(llm_cache, max_per_endpoint)
     if use_preprocessing:
         cmd.append("--use_table_detection")
     return cmd
 
-def run_task(filename: str, instruction: str, mode: str, use_preprocessing: bool, show_live_output: bool):
+
+class ProgressTracker:
+    """ Tiene traccia dei task completati e stampa avanzamento ed ETA """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.running = 0
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def task_started(self):
+        with self.lock:
+            self.running += 1
+
+    def task_finished(self, success: bool, label: str):
+        with self.lock:
+            self.running -= 1
+            self.done += 1
+            if not success:
+                self.failed += 1
+            status = "OK" if success else "ERRORE"
+            print(f"[{status}] {label}\n{self._format()}", flush=True)
+
+    def report(self):
+        with self.lock:
+            print(self._format(), flush=True)
+
+    def _format(self) -> str:
+        elapsed = time.monotonic() - self.start_time
+        if self.done > 0:
+            eta = format_seconds(elapsed / self.done * (self.total - self.done))
+        else:
+            eta = "--:--:--"
+        percent = 100 * self.done / self.total if self.total else 100.0
+        return (
+            f"Avanzamento: {self.done}/{self.total} ({percent:.1f}%) | in corso: {self.running} | "
+            f"errori: {self.failed} | trascorso: {format_seconds(elapsed)} | ETA: {eta}"
+        )
+
+def format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def run_task(filename: str, instruction: str, mode: str, use_preprocessing: bool, show_live_output: bool,
+             llm_cache: str = None, max_per_endpoint: int = MAX_PER_ENDPOINT) -> bool:
     """ Esegue SheetAgent su una combinazione file/modalità """
     base_id = Path(filename).stem
     output_dir = BASE_OUTPUT_DIR / mode / base_id
     output_dir.mkdir(parents=True, exist_ok=True)
+    # ogni task usa un proprio database, così i task paralleli non si sovrascrivono
+    db_path = BASE_DB_DIR / mode / base_id
     workbook_path = DATASET_DIR / filename
 
+    command = build_command(workbook_path, instruction, output_dir, db_path, use_preprocessing, llm_cache,
+                            max_per_endpoint)
+    if not show_live_output:
+        # Con più worker l'output di ogni task va nel proprio file di log
+        try:
+            with open(output_dir / "log.txt", "w", encoding="utf-8") as log_file:
+                process = subprocess.run(command, stdout=log_file, stderr=subprocess.STDOUT, text=True,
+                                         timeout=TASK_TIME_LIMIT + TASK_KILL_GRACE)
+        except FileNotFoundError:
+            print("ERRORE: 'python' non trovato. Assicurati che Python sia nel PATH.")
+            return False
+        except subprocess.TimeoutExpired:
+            print(f"ERRORE: {filename} in modalità {mode} non terminato entro il tempo massimo, interrotto. "
+                  f"Log in: {output_dir / 'log.txt'}")
+            return False
+        if process.returncode != 0:
+            print(f"ERRORE durante l'esecuzione per {filename} in modalità {mode}. Log in: {output_dir / 'log.txt'}")
+            return False
+        return True
+
     print("-" * 60)
     print(f"Processing: {filename} (id: {base_id}) [{mode}]")
     print(f"Istruzione: {instruction}")
     print("-" * 60)
-
-    command = build_command(workbook_path, instruction, output_dir, use_preprocessing)
     print(f"Comando: {' '.join(command)}")
     try:
-        if show_live_output:
-            # Output in tempo reale
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
-            )
+        # Output in tempo reale
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        # il task viene terminato se supera il tempo massimo
+        killer = threading.Timer(TASK_TIME_LIMIT + TASK_KILL_GRACE, process.kill)
+        killer.start()
+        try:
             while True:
                 output = process.stdout.readline()
                 if output == '' and process.poll() is not None:
@@ -98,20 +205,49 @@ def run_task(filename: str, instruction: str, mode: str, use_preprocessing: bool
                 if output:
                     print(output.strip())
             _, stderr = process.communicate()
-            if process.returncode != 0:
-                print(f"ERRORE durante l'esecuzione per {filename} in modalità {mode}.")
-                print(f"Errore: {stderr}")
-            else:
-                print(f"Esecuzione completata con successo. Output in: {output_dir}")
-        else:
-            process = subprocess.run(command, check=True, text=True)
-            print(f"Esecuzione completata con successo. Output in: {output_dir}")
-    except subprocess.CalledProcessError as e:
-        print(f"ERRORE durante l'esecuzione per {filename} in modalità {mode}.")
+        finally:
+            killer.cancel()
+        if process.returncode != 0:
+            print(f"ERRORE durante l'esecuzione per {filename} in modalità {mode}.")
+            print(f"Errore: {stderr}")
+            return False
+        print(f"Esecuzione completata con successo. Output in: {output_dir}")
+        return True
+    except FileNotFoundError:
+        print("ERRORE: 'python' non trovato. Assicurati che Python sia nel PATH.")
+        return False
+
+def run_batch(tasks, max_workers: int, llm_cache: str = None, max_per_endpoint: int = MAX_PER_ENDPOINT) -> bool:
+    """ Esegue tutti i task in un solo processo di main.py, che tiene pronti i worker per il codice dell'agente """
+    BASE_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    task_file = BASE_OUTPUT_DIR / "tasks.jsonl"
+    with open(task_file, "w", encoding="utf-8") as f:
+        for filename, instruction, mode_name, use_preprocessing in tasks:
+            base_id = Path(filename).stem
+            task = {
+                "workbook_path": str(DATASET_DIR / filename),
+                "instruction": instruction,
+                "output_dir": str(BASE_OUTPUT_DIR / mode_name / base_id),
+                "db_path": str(BASE_DB_DIR / mode_name / base_id),
+                "use_table_detection": use_preprocessing,
+            }
+            f.write(json.dumps(task, ensure_ascii=False) + "\n")
+
+    command = [
+        sys.executable,
+        str(SHEETAGENT_MAIN_PY),
+        "--task_file", str(task_file),
+        "--workers", str(max_workers),
+    ] + common_options(llm_cache, max_per_endpoint)
+    try:
+        process = subprocess.run(command)
     except FileNotFoundError:
         print("ERRORE: 'python' non trovato. Assicurati che Python sia nel PATH.")
+        return False
+    return process.returncode == 0
 
-def run_benchmark(show_live_output=True):
+def run_benchmark(show_live_output=True, max_workers=MAX_WORKERS, max_per_endpoint=MAX_PER_ENDPOINT, llm_cache=None,
+                  single_process=False):
     """ Funzione principale di orchestrazione """
     print("Caricamento del file di benchmark...")
     benchmark_map = load_benchmark_instructions(BENCHMARK_XLSX_PATH)
@@ -122,22 +258,87 @@ def run_benchmark(show_live_output=True):
     files_to_process = get_files_to_process(DATASET_DIR)
     clear_all_outputs()
 
-    for i, filename in enumerate(files_to_process):
+    tasks = []
+    for filename in files_to_process:
         item = benchmark_map.get(filename)
         if not item:
             print(f"ATTENZIONE: Nessuna istruzione trovata per il file '{filename}'. Salto.")
             continue
-
         for mode_name, use_preprocessing in PREPROCESSING_MODES:
-            run_task(
+            tasks.append((filename, item['Instruction'], mode_name, use_preprocessing))
+
+    if single_process:
+        print(f"Esecuzione di {len(tasks)} task in un solo processo con {max_workers} worker.")
+        if not run_batch(tasks, max_workers, llm_cache, max_per_endpoint):
+            print("ERRORE: alcuni task non sono stati completati.")
+        print("\nBenchmark completato!")
+        return
+
+    # l'output in tempo reale ha senso solo con un singolo worker
+    show_live_output = show_live_output and max_workers == 1
+    progress = ProgressTracker(len(tasks))
+    print(f"Esecuzione di {len(tasks)} task con {max_workers} worker (max {max_per_endpoint} richieste LLM in corso).")
+
+    def worker(filename, instruction, mode_name, use_preprocessing):
+        progress.task_started()
+        success = False
+        try:
+            success = run_task(
                 filename=filename,
-                instruction=item['Instruction'],
+                instruction=instruction,
                 mode=mode_name,
                 use_preprocessing=use_preprocessing,
-                show_live_output=show_live_output
+                show_live_output=show_live_output,
+                llm_cache=llm_cache,
+                max_per_endpoint=max_per_endpoint
             )
+        finally:
+            progress.task_finished(success, f"{filename} [{mode_name}]")
 
+    stop_reporting = threading.Event()
+
+    def reporter():
+        while not stop_reporting.wait(PROGRESS_INTERVAL):
+            progress.report()
+
+    reporter_thread = threading.Thread(target=reporter, daemon=True)
+    reporter_thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(worker, *task) for task in tasks]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        stop_reporting.set()
+
+    progress.report()
     print("\nBenchmark completato!")
 
 if __name__ == "__main__":
-    run_benchmark()
+    parser = ArgumentParser()
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Numero di task eseguiti in parallelo.")
+    parser.add_argument(
+        "--max_per_endpoint", type=int, default=MAX_PER_ENDPOINT, help="Richieste LLM in corso massime per endpoint."
+    )
+    parser.add_argument("--quiet", action="store_true", help="Non mostrare l'output dei task in tempo reale.")
+    parser.add_argument(
+        "--llm_cache",
+        type=str,
+        choices=["record", "replay", "passthrough"],
+        default=None,
+        help="record: salva le risposte del modello; replay: le rilegge senza interrogare il modello.",
+    )
+    parser.add_argument(
+        "--single_process",
+        action="store_true",
+        help="Esegue tutti i task in un solo processo, con i worker del codice dell'agente già pronti.",
+    )
+    args = parser.parse_args()
+
+    run_benchmark(
+        show_live_output=not args.quiet,
+        max_workers=args.workers,
+        max_per_endpoint=args.max_per_endpoint,
+        llm_cache=args.llm_cache,
+        single_process=args.single_process,
+    )
@@ -0,0 +1,118 @@
+import json
+import re
+import sqlite3
+import tempfile
+import unittest
+from io import StringIO
+from pathlib import Path
+
+import pandas as pd
+
+from dataset.cache import create_database
+from utils.serializers import sqltb2dfloader, sqltb2html, sqltb2json, sqltb2markdown
+
+DATASET_DIR = Path(__file__).resolve().parent.parent / "dataset_90"
+
+
+# the serializers as they were before the CSV round-trip was replaced, the new ones must print the same text
+
+
+def baseline_wtqtb2df(wtq_tb: dict) -> pd.DataFrame:
+    header, rows = wtq_tb["header"], wtq_tb["rows"]
+    df = pd.DataFrame(data=rows, columns=header)
+    buffer = StringIO()
+    df.to_csv(buffer, index=False)
+    df_new = pd.read_csv(StringIO(buffer.getvalue()))
+    return df_new.convert_dtypes()
+
+
+def baseline_sqltb2json(wtq_tb: dict, add_row_number: bool, lower_case: bool):
+    df = baseline_wtqtb2df(wtq_tb)
+
+    table_json = {}
+    for idx, (_, row) in enumerate(df.iterrows()):
+        row_dict = row.to_dict()
+        if add_row_number:
+            row_number_col = "row number" if lower_case else "Row Number"
+            row_number = row[row_number_col]
+            del row_dict[row_number_col]
+        else:
+            row_number = idx + 1
+        table_json[row_number] = row_dict
+
+    formatted_table_json = "{\n"
+    for k, v in table_json.items():
+        formatted_table_json += f'  "{k}":{json.dumps(v, separators=(",", ":"))},\n'
+    return formatted_table_json.rstrip(",\n") + "\n}"
+
+
+def baseline_sqltb2markdown(wtq_tb: dict):
+    return baseline_wtqtb2df(wtq_tb).to_markdown(index=False)
+
+
+def baseline_sqltb2html(wtq_tb: dict):
+    df = baseline_wtqtb2df(wtq_tb)
+
+    table_html = df.to_html(index=False, bold_rows=False, border=0, escape=False)
+    table_html = re.sub(r'\s*style\s*=\s*"[^"]*"', "", table_html)
+    table_html = re.sub(r'\s*class\s*=\s*"[^"]*"', "", table_html)
+    table_html = re.sub(r"(</th>)\s+(<th>)", r"\1\2", table_html)
+    table_html = re.sub(r"(</td>)\s+(<td>)", r"\1\2", table_html)
+    table_html = re.sub(r"(<tr>)\s+(<th>)", r"\1\2", table_html)
+    table_html = re.sub(r"(</th>)\s+(</tr>)", r"\1\2", table_html)
+    table_html = re.sub(r"(<tr>)\s+(<td>)", r"\1\2", table_html)
+    table_html = re.sub(r"(</td>)\s+(</tr>)", r"\1\2", table_html)
+    return table_html
+
+
+def baseline_sqltb2dfloader(wtq_tb: dict):
+    df = baseline_wtqtb2df(wtq_tb)
+
+    col_vals = []
+    for col in df.columns:
+        vals = df[col].tolist()
+        col_vals.append(f'"{col}": {vals}')
+    col_vals = ",\n    ".join(col_vals)
+    return f"pd.DataFrame({{\n    {col_vals}\n}})"
+
+
+def query_results(db_path: Path):
+    """Header and rows of each table of the database, of each of its columns and of its row count."""
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+            queries = [f'SELECT * FROM "{table}"', f'SELECT COUNT(*) AS n FROM "{table}"']
+            queries += [f'SELECT "{column}" FROM "{table}"' for column in columns]
+            for query in queries:
+                cursor = conn.execute(query)
+                yield query, {"header": [d[0] for d in cursor.description], "rows": cursor.fetchall()}
+    finally:
+        conn.close()
+
+
+class SerializersMatchBaselineTest(unittest.TestCase):
+    def test_dataset_tables(self):
+        workbooks = sorted(DATASET_DIR.glob("*.xlsx"))
+        if not workbooks:
+            self.skipTest(f"no workbooks in {DATASET_DIR}")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for workbook in workbooks:
+                db_path = Path(tmp_dir) / f"{workbook.stem}.db"
+                try:
+                    create_database(workbook, db_path)
+                except sqlite3.Error:  # e.g. sheets with column names differing only in case
+                    continue
+                for query, tb in query_results(db_path):
+                    with self.subTest(workbook=workbook.name, query=query):
+                        self.assertEqual(sqltb2json(tb, False, True), baseline_sqltb2json(tb, False, True))
+                        if "row number" in tb["header"]:
+                            self.assertEqual(sqltb2json(tb, True, True), baseline_sqltb2json(tb, True, True))
+                        self.assertEqual(sqltb2markdown(tb), baseline_sqltb2markdown(tb))
+                        self.assertEqual(sqltb2html(tb), baseline_sqltb2html(tb))
+                        self.assertEqual(sqltb2dfloader(tb), baseline_sqltb2dfloader(tb))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,5 @@
+from typing import List
+
 from utils.enumeration import EXEC_CODE, OBS_TYPE
 
 
@@ -24,3 +26,34 @@ class ToolResponse:
 
     def __repr__(self) -> str:
         return self.__str__()
+
+
+class SheetState:
+    def __init__(self, name: str, n_rows: int, n_cols: int, headers: List, data_types: List[str]) -> None:
+        self.name = name
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.headers = headers
+        # class of the values in the first data row, e.g. "<class 'int'>"
+        self.data_types = data_types
+
+    @property
+    def is_empty(self) -> bool:
+        return self.n_rows == 0
+
+    def describe(self) -> str:
+        if self.is_empty:
+            return f'Sheet "{self.name}" is empty. '
+        headers_str = ", ".join(
+            [
+                f'{chr(65 + i)}({i+1}): "{header}" ({data_type})'
+                for i, (header, data_type) in enumerate(zip(self.headers, self.data_types))
+            ]
+        )
+        return f'Sheet "{self.name}" has {self.n_rows} rows (Including the header row) and {self.n_cols} columns ({headers_str}). '
+
+    def __str__(self) -> str:
+        return f"Sheet State: {self.name}, {self.n_rows}x{self.n_cols}"
+
+    def __repr__(self) -> str:
+        return self.__str__()
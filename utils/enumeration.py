@@ -44,3 +44,12 @@ class ROLE(Enum):
     SYSTEM = "system"
     USER = "user"
     ASSISTANT = "assistant"
+
+
+class CACHE_MODE(Enum):
+    PASSTHROUGH = "passthrough"
+    RECORD = "record"
+    REPLAY = "replay"
+
+    def __str__(self) -> str:
+        return self.value
@@ -20,4 +20,24 @@ class CriticParseError(Exception):
 
 class TokenLimitError(Exception):
     def __init__(self, num_tokens:int, token_limit:int) -> None:
-        super().__init__(f"Number of tokens {num_tokens} exceeds the limit {token_limit}.")
\ No newline at end of file
+        super().__init__(f"Number of tokens {num_tokens} exceeds the limit {token_limit}.")
+
+class CacheMissError(Exception):
+    def __init__(self, key: str) -> None:
+        self.key = key
+        super().__init__(f"No cached response for query {key} in replay mode.")
+
+class LLMRequestError(Exception):
+    def __init__(self, msg) -> None:
+        super().__init__(msg)
+
+class CircuitOpenError(LLMRequestError):
+    def __init__(self, endpoint: str, retry_in: float) -> None:
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+        super().__init__(f"Endpoint {endpoint} is unavailable, requests are suspended for {retry_in:.1f}s.")
+
+class SandboxCrashError(Exception):
+    def __init__(self, exit_code, reason: str = "terminated unexpectedly") -> None:
+        self.exit_code = exit_code
+        super().__init__(f"The Python process running the code {reason} (exit code {exit_code}).")
\ No newline at end of file
@@ -0,0 +1,425 @@
+import importlib.util
+import math
+import re
+from json.encoder import encode_basestring_ascii
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+# Query results used to be typed by writing them to CSV and reading them back with `pd.read_csv`. The values are now
+# typed directly from what SQLite returns, following the same rules, so the serialized tables do not change.
+
+# default `na_values` of `pd.read_csv`
+NA_VALUES = frozenset(
+    ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA"]
+    + ["NULL", "NaN", "None", "n/a", "nan", "null"]
+)
+INT_PATTERN = re.compile(r"[ \t\n\v\f\r]*[+-]?[0-9]+[ \t\n\v\f\r]*")
+FLOAT_PATTERN = re.compile(r"[ \t\n\v\f\r]*[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?[ \t\n\v\f\r]*")
+INF_VALUES = {"inf": np.inf, "+inf": np.inf, "infinity": np.inf, "+infinity": np.inf, "-inf": -np.inf, "-infinity": -np.inf}
+BOOL_VALUES = {"true": True, "false": False}
+INT64_MIN, INT64_MAX, UINT64_MAX = -(2**63), 2**63 - 1, 2**64 - 1
+ASCII_SPACE = " \t\n\v\f\r"
+
+
+def mangle_header(header: list) -> List[str]:
+    """Column names as `pd.read_csv` reads them: empty names become "Unnamed: i", duplicates get a ".n" suffix."""
+    names = [str(name) if str(name) != "" else f"Unnamed: {i}" for i, name in enumerate(header)]
+    unnamed = [i for i, name in enumerate(header) if str(name) == ""]
+    named = [i for i, name in enumerate(header) if str(name) != ""]
+    counts: Dict[str, int] = {}
+    for i in named + unnamed:  # given names keep priority over the mangled ones
+        col = old_col = names[i]
+        cur_count = counts.get(col, 0)
+        while cur_count > 0:
+            counts[old_col] = cur_count + 1
+            col = f"{old_col}.{cur_count}"
+            cur_count = cur_count + 1 if col in names else counts.get(col, 0)
+        names[i] = col
+        counts[col] = cur_count + 1
+    return names
+
+
+def parse_floats(texts: list) -> np.ndarray:
+    # `pd.to_numeric` uses the float parser of `pd.read_csv`, which is not always correctly rounded; a trailing
+    # point keeps it from parsing integers as integers
+    texts = [text.strip(ASCII_SPACE) + "." if INT_PATTERN.fullmatch(text) else text for text in texts]
+    return pd.to_numeric(np.array(texts, dtype=object)).astype(np.float64)
+
+
+def parse_ints(texts: List[str], is_na: List[bool]):
+    """Integer column `pd.read_csv` parses from the fields, None if they are not all integers. Like the C parser,
+    the fields are read as int64 up to the first one that is not, and as uint64 again if it overflows."""
+    for text, na in zip(texts, is_na):
+        if na:
+            continue
+        if not INT_PATTERN.fullmatch(text):
+            return None
+        if not INT64_MIN <= int(text) <= INT64_MAX:
+            break
+    else:
+        if not any(is_na):
+            return np.array([int(text) for text in texts], dtype=np.int64)
+        # missing values turn the column to float
+        return np.array([np.nan if na else int(text) for text, na in zip(texts, is_na)], dtype=np.float64)
+
+    seen_sint = seen_uint = False
+    for text, na in zip(texts, is_na):
+        if na:
+            continue
+        if text.lstrip(ASCII_SPACE).startswith("-"):
+            seen_sint = True
+        elif not INT_PATTERN.fullmatch(text):
+            return None
+        elif int(text) > UINT64_MAX:
+            # integers out of the 64-bit range are kept as text
+            return np.array([np.nan if na else text for text, na in zip(texts, is_na)], dtype=object)
+        elif int(text) > INT64_MAX:
+            seen_uint = True
+    if not seen_uint:
+        return np.array([np.nan if na else text for text, na in zip(texts, is_na)], dtype=object)
+    if seen_sint or any(is_na):
+        # unsigned integers mixed with negative or missing values are left as they are, missing values included
+        return np.array(texts, dtype=object)
+    return np.array([int(text) for text in texts], dtype=np.uint64)
+
+
+def infer_text_column(texts: List[str]) -> np.ndarray:
+    """Values `pd.read_csv` parses from a column of CSV fields."""
+    is_na = [text in NA_VALUES for text in texts]
+    values = [text for text, na in zip(texts, is_na) if not na]
+    has_na = len(values) < len(texts)
+    if not values:
+        return np.full(len(texts), np.nan)
+
+    ints = parse_ints(texts, is_na)
+    if ints is not None:
+        return ints
+    if all(FLOAT_PATTERN.fullmatch(text) or text.lower() in INF_VALUES for text in values):
+        result = np.full(len(texts), np.nan)
+        finite = [i for i, text in enumerate(texts) if not is_na[i] and text.lower() not in INF_VALUES]
+        for i, text in enumerate(texts):
+            if not is_na[i] and text.lower() in INF_VALUES:
+                result[i] = INF_VALUES[text.lower()]
+        if finite:
+            result[finite] = parse_floats([texts[i] for i in finite])
+        return result
+    if all(text.lower() in BOOL_VALUES for text in values):
+        if not has_na:
+            return np.array([BOOL_VALUES[text.lower()] for text in values], dtype=bool)
+        return np.array([np.nan if na else BOOL_VALUES[text.lower()] for text, na in zip(texts, is_na)], dtype=object)
+
+    return np.array([np.nan if na else text for text, na in zip(texts, is_na)], dtype=object)
+
+
+def infer_column(values: list) -> np.ndarray:
+    """Values `pd.read_csv` parses from the CSV text of a column of SQLite values."""
+    if not values:
+        return np.array([], dtype=object)
+    types = set(map(type, values))
+    has_null = type(None) in types
+    types.discard(type(None))
+    if not types:
+        return np.full(len(values), np.nan)
+    if types == {int} and not has_null:
+        return np.array(values, dtype=np.int64)
+    if types <= {int, float}:
+        # a float column, written with the shortest repr and parsed back
+        floats = np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+        finite = np.isfinite(floats)
+        floats[finite] = parse_floats(floats[finite].astype(str).tolist())
+        return floats
+    return infer_text_column(["" if value is None else str(value) for value in values])
+
+
+def wtqtb2df(wtq_tb: dict) -> pd.DataFrame:
+    """This function will convert a table dict to a pandas dataframe with correct data type (auto infer)."""
+    header, rows = wtq_tb["header"], wtq_tb["rows"]
+    if len(header) == 1:
+        # a single value of spaces and tabs is written as a blank line, which `pd.read_csv` skips
+        rows = [row for row in rows if not (isinstance(row[0], str) and row[0] and not row[0].strip(" \t"))]
+    columns = [list(column) for column in zip(*rows)] if len(rows) > 0 else [[] for _ in header]
+    data = {name: infer_column(column) for name, column in zip(mangle_header(header), columns)}
+    return pd.DataFrame(data).convert_dtypes()
+
+
+def column_kind(series: pd.Series) -> str:
+    if isinstance(series.dtype, pd.BooleanDtype):
+        return "bool"
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return "int"
+    if pd.api.types.is_float_dtype(series.dtype):
+        return "float"
+    if isinstance(series.dtype, pd.StringDtype):
+        return "str"
+    return "object"
+
+
+def is_missing(value) -> bool:
+    return value is None or value is pd.NA or (isinstance(value, float) and value != value)
+
+
+def json_float(value: float) -> str:
+    if value != value:
+        return "NaN"
+    if value in (np.inf, -np.inf):
+        return "Infinity" if value > 0 else "-Infinity"
+    return float.__repr__(value)
+
+
+JSON_ENCODERS: Dict[type, Callable] = {
+    int: int.__repr__,
+    float: json_float,
+    bool: lambda value: "true" if value else "false",
+    str: encode_basestring_ascii,
+}
+
+
+def json_value(value) -> str:
+    if value is None or value is pd.NA:
+        return "null"
+    return JSON_ENCODERS[type(value)](value)
+
+
+def sqltb2json(wtq_tb: dict, add_row_number: bool = False, lower_case: bool = False, first_row_number: int = 1):
+    df = wtqtb2df(wtq_tb)
+
+    # the rows are the ones `DataFrame.iterrows` yields: a row of strings and missing values is a string Series,
+    # in which the missing values are NaN, in the other rows they are null
+    vals = df.values
+    rows = vals.tolist()
+    keys = [encode_basestring_ascii(str(col)) + ":" for col in df.columns]
+    if add_row_number and len(rows) > 0:
+        row_number_col = "row number" if lower_case else "Row Number"
+        row_number_idx = df.columns.get_loc(row_number_col)
+    else:
+        row_number_idx = None
+
+    table_json = {}
+    for idx, row in enumerate(rows):
+        if vals.dtype == object and any(isinstance(value, str) for value in row):
+            if all(isinstance(value, str) or is_missing(value) for value in row):
+                row = [value if isinstance(value, str) else np.nan for value in row]
+        cells = [key + json_value(value) for key, value in zip(keys, row)]
+        if row_number_idx is not None:
+            row_number = row[row_number_idx]
+            del cells[row_number_idx]
+        else:
+            row_number = idx + first_row_number
+        table_json[row_number] = "{" + ",".join(cells) + "}"
+
+    formatted_table_json = "{\n" + "".join(f'  "{k}":{v},\n' for k, v in table_json.items())
+    formatted_table_json = formatted_table_json.rstrip(",\n") + "\n}"
+
+    return formatted_table_json
+
+
+# tabulate measures wide characters with wcwidth when it is installed
+WIDE_CHARS = importlib.util.find_spec("wcwidth") is not None
+THOUSANDS_PATTERN = re.compile(r"^(([+-]?[0-9]{1,3})(?:,([0-9]{3}))*)?(?(1)\.[0-9]*|\.[0-9]+)?$")
+TYPE_ORDER = {type(None): 0, bool: 1, int: 2, float: 3, str: 5}
+
+
+def is_convertible(conv, text: str) -> bool:
+    try:
+        conv(text)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+def is_number(text: str) -> bool:
+    if not is_convertible(float, text):
+        return False
+    value = float(text)
+    return math.isfinite(value) or text.lower() in ["inf", "-inf", "nan"]
+
+
+def text_type(text: str) -> type:
+    """Type tabulate deduces for a string cell."""
+    if not text:
+        return type(None)
+    if text in ("True", "False"):
+        return bool
+    if is_convertible(int, text) or (THOUSANDS_PATTERN.match(text) and "." not in text):
+        return int
+    if is_number(text) or THOUSANDS_PATTERN.match(text):
+        return float
+    return str
+
+
+def after_point(text: str) -> int:
+    if is_number(text) or THOUSANDS_PATTERN.match(text):
+        if is_convertible(int, text):
+            return -1
+        pos = text.rfind(".")
+        pos = text.lower().rfind("e") if pos < 0 else pos
+        return len(text) - pos - 1 if pos >= 0 else -1
+    return -1
+
+
+def cell_type(value) -> type:
+    """Type tabulate deduces for a cell."""
+    if value is None:
+        return type(None)
+    if type(value) is bool:
+        return bool
+    if isinstance(value, (int, np.integer)):
+        return int
+    if isinstance(value, (float, np.floating, np.bool_)):
+        return float
+    if isinstance(value, str):
+        return text_type(value)
+    return str  # tabulate does not recognise pd.NA as a missing value
+
+
+def markdown_float(value) -> str:
+    if isinstance(value, str):
+        if not value:
+            return ""
+        value = value.replace(",", "")  # thousands separators
+    try:
+        return format(float(value), "g")
+    except (ValueError, TypeError):
+        return f"{value}"
+
+
+def markdown_column(values: np.ndarray):
+    """Formatted cells and alignment of a column of `DataFrame.values`, as `tabulate` renders it with the "pipe"
+    format."""
+    if values.dtype == np.bool_ or values.dtype.kind == "u":
+        col_type = float  # tabulate only takes numpy signed integers for integers
+    elif values.dtype.kind == "i":
+        col_type = int
+    elif values.dtype.kind == "f":
+        col_type = float
+    else:
+        col_type = bool
+        for value in values:
+            value_type = cell_type(value)
+            if TYPE_ORDER[value_type] > TYPE_ORDER[col_type]:
+                col_type = value_type
+                if col_type is str:
+                    break
+
+    values = values.tolist()
+    if col_type is float:
+        cells = [markdown_float(value) for value in values]
+    else:
+        cells = [f"{value}" for value in values]
+
+    if col_type is int:
+        return cells, "decimal"  # no decimal point to align
+    if col_type is float:
+        decimals = [after_point(cell) for cell in cells]
+        max_decimals = max(decimals)
+        return [cell + (max_decimals - decs) * " " for cell, decs in zip(cells, decimals)], "decimal"
+    return [cell.strip() for cell in cells], "left"
+
+
+def sqltb2markdown(wtq_tb: dict, add_row_number: bool = False, lower_case: bool = False):
+    df = wtqtb2df(wtq_tb)
+
+    # tabulate reads the rows of `DataFrame.values`
+    vals = df.values
+    headers = [str(col) for col in df.columns]
+    texts = headers + [value for value in vals.ravel().tolist() if isinstance(value, str)]
+    if (
+        len(df) == 0
+        or any("\n" in text or "\r" in text or "\x1b" in text or "\x01" in text for text in texts)
+        or (WIDE_CHARS and not all(text.isascii() for text in texts))
+    ):
+        # multiline cells, ANSI codes and wide characters are left to tabulate
+        return df.to_markdown(index=False)
+
+    columns, aligns, widths = [], [], []
+    for j, header in enumerate(headers):
+        cells, align = markdown_column(vals[:, j])
+        width = max(max(map(len, cells)), len(header) + 2)
+        pad = str.rjust if align == "decimal" else str.ljust
+        columns.append([pad(cell, width) for cell in cells])
+        aligns.append(align)
+        widths.append(width)
+
+    header_cells = [(str.rjust if a == "decimal" else str.ljust)(h, w) for h, a, w in zip(headers, aligns, widths)]
+    rule = "|".join(("-" * (w + 1)) + ":" if a == "decimal" else ":" + ("-" * (w + 1)) for a, w in zip(aligns, widths))
+    lines = ["| " + " | ".join(header_cells) + " |", f"|{rule}|"]
+    lines.extend("| " + " | ".join(row) + " |" for row in zip(*columns))
+    return "\n".join(lines)
+
+
+def html_float(value: float) -> str:
+    text = f"{value: .6f}".rstrip("0")
+    return text + "0" if text.endswith(".") else text
+
+
+HTML_ESCAPES = str.maketrans({"\t": "\\t", "\r": "\\r", "\n": "\\n"})
+# texts the attribute and whitespace cleanup of `sqltb2html` could act upon
+HTML_CLEANUP_PATTERN = re.compile(r"style|class|</?t[dhr]>")
+
+
+def html_cell(text: str) -> str:
+    return text.strip().replace("  ", "&nbsp;&nbsp;")
+
+
+def html_column(series: pd.Series) -> List[str]:
+    """Cell texts of a column as `DataFrame.to_html` formats them."""
+    kind = column_kind(series)
+    if kind == "float":
+        fmt = html_float
+    elif kind == "str":
+        fmt = lambda value: value.translate(HTML_ESCAPES)  # noqa: E731
+    else:
+        fmt = str
+    return ["<NA>" if value is pd.NA else html_cell(fmt(value)) for value in series.tolist()]
+
+
+def sqltb2html(wtq_tb: dict, add_row_number: bool = False, lower_case: bool = False):
+    df = wtqtb2df(wtq_tb)
+
+    headers = [html_cell(str(col)) for col in df.columns]
+    columns = [html_column(df[col]) for col in df.columns]
+    texts = headers + [cell for column in columns for cell in column]
+    if not any(HTML_CLEANUP_PATTERN.search(text) for text in texts):
+        # the attributes and the whitespace between tags are not written in the first place
+        head = "    <tr>" + "".join(f"<th>{header}</th>" for header in headers) + "</tr>\n"
+        body = "".join("    <tr>" + "".join(f"<td>{cell}</td>" for cell in row) + "</tr>\n" for row in zip(*columns))
+        return f"<table>\n  <thead>\n{head}  </thead>\n  <tbody>\n{body}  </tbody>\n</table>"
+
+    head = "".join(f"      <th>{header}</th>\n" for header in headers)
+    body = "".join(
+        "    <tr>\n" + "".join(f"      <td>{cell}</td>\n" for cell in row) + "    </tr>\n" for row in zip(*columns)
+    )
+    table_html = (
+        '<table class="dataframe">\n  <thead>\n    <tr style="text-align: right;">\n'
+        f"{head}    </tr>\n  </thead>\n  <tbody>\n{body}  </tbody>\n</table>"
+    )
+    # remove style attr
+    table_html = re.sub(r'\s*style\s*=\s*"[^"]*"', "", table_html)
+
+    # remove class attr
+    table_html = re.sub(r'\s*class\s*=\s*"[^"]*"', "", table_html)
+    table_html = re.sub(r"(</th>)\s+(<th>)", r"\1\2", table_html)
+    table_html = re.sub(r"(</td>)\s+(<td>)", r"\1\2", table_html)
+
+    table_html = re.sub(r"(<tr>)\s+(<th>)", r"\1\2", table_html)
+    table_html = re.sub(r"(</th>)\s+(</tr>)", r"\1\2", table_html)
+    table_html = re.sub(r"(<tr>)\s+(<td>)", r"\1\2", table_html)
+    table_html = re.sub(r"(</td>)\s+(</tr>)", r"\1\2", table_html)
+
+    return table_html
+
+
+def sqltb2dfloader(wtq_tb: dict, add_row_number: bool = False, lower_case: bool = False):
+    df = wtqtb2df(wtq_tb)
+
+    col_vals = []
+    for col in df.columns:
+        vals = df[col].tolist()
+        col_vals.append(f'"{col}": {vals}')
+
+    col_vals = ",\n    ".join(col_vals)
+
+    tb_dfloader = f"pd.DataFrame({{\n    {col_vals}\n}})"
+    return tb_dfloader
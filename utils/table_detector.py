@@ -1,13 +1,151 @@
 # -*- coding: utf-8 -*-
-import openpyxl
+import json
+import os
+import threading
+from pathlib import Path
+
 import numpy as np
-from sklearn.cluster import DBSCAN
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from utils.workbook import load_workbook, workbook_digest
+
+# da incrementare quando cambia l'algoritmo, così i risultati in cache non più validi vengono ignorati
+DETECTION_CACHE_VERSION = 1
+DETECTION_CACHE_DIRNAME = "table_detection"
+
+def style_score(cell):
+    """ Punteggio dovuto allo stile della cella: bordi, grassetto e colore di sfondo """
+    score = 0
+
+    # Punteggio per i bordi
+    if cell.border.left.style: score += 2
+    if cell.border.right.style: score += 2
+    if cell.border.top.style: score += 2
+    if cell.border.bottom.style: score += 2
+
+    # Punteggio per lo stile del font (es. grassetto)
+    if cell.font and cell.font.bold:
+        score += 3  # Punteggio alto per il grassetto, forte indicatore di intestazione
+
+    # Punteggio per il colore di sfondo (fill)
+    if cell.fill and cell.fill.fill_type and cell.fill.fill_type != 'none':
+        score += 1 # Punteggio più basso, a volte è solo decorativo
+
+    return score
+
+def extract_cell_scores(sheet):
+    """
+    Calcola in un solo passaggio i punteggi basati su contenuto, bordi e stile.
+    Visita solo le celle memorizzate nel foglio (quelle mai scritte hanno punteggio 0),
+    quindi la memoria è proporzionale alle celle non vuote. Il punteggio di stile viene
+    calcolato una sola volta per ogni combinazione di bordo, font e fill.
+
+    Returns:
+        tuple: (coordinate Nx2 in base 0 ordinate per riga e colonna, punteggi N)
+    """
+    style_scores = {}
+    rows, cols, scores = [], [], []
+    for (r_idx, c_idx), cell in sheet._cells.items():
+        style = cell._style
+        style_key = (style.borderId, style.fontId, style.fillId)
+        score = style_scores.get(style_key)
+        if score is None:
+            score = style_scores[style_key] = style_score(cell)
+
+        # Punteggio per il contenuto
+        value = cell.value
+        if value is not None and str(value).strip() != "":
+            score += 1
+
+        if score > 0:
+            rows.append(r_idx - 1)
+            cols.append(c_idx - 1)
+            scores.append(score)
+
+    rows = np.array(rows, dtype=int)
+    cols = np.array(cols, dtype=int)
+    order = np.lexsort((cols, rows))
+    X = np.column_stack((rows[order], cols[order])) if len(order) > 0 else np.empty((0, 2), dtype=int)
+    return X, np.array(scores, dtype=int)[order]
+
+def grid_neighbor_pairs(X, max_eps):
+    """
+    Calcola una sola volta tutte le coppie di celle (i < j) a distanza <= max_eps e la loro distanza.
+    Le celle stanno su una griglia intera, quindi basta cercare, per ogni spostamento (dr, dc)
+    con dr² + dc² <= max_eps², la cella di arrivo tra le chiavi ordinate delle celle.
+
+    Returns:
+        tuple: (indici i, indici j, distanze)
+    """
+    n = len(X)
+    radius = int(np.floor(max_eps))
+    max_c = int(X[:, 1].max())
+    stride = max_c + radius + 1
+    # X è ordinato per riga e colonna, quindi anche le chiavi sono ordinate
+    keys = X[:, 0] * stride + X[:, 1]
+
+    pairs_i, pairs_j, dists = [], [], []
+    for dr in range(0, radius + 1):
+        for dc in range(-radius, radius + 1):
+            if dr == 0 and dc <= 0:
+                continue  # ogni coppia viene considerata una sola volta
+            dist = np.sqrt(dr * dr + dc * dc)
+            if dist > max_eps:
+                continue
+            cols = X[:, 1] + dc
+            target = keys + dr * stride + dc
+            pos = np.minimum(np.searchsorted(keys, target), n - 1)
+            hit = (cols >= 0) & (cols <= max_c) & (keys[pos] == target)
+            pairs_i.append(np.flatnonzero(hit))
+            pairs_j.append(pos[hit])
+            dists.append(np.full(int(hit.sum()), dist))
+
+    if not pairs_i:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0)
+    return np.concatenate(pairs_i), np.concatenate(pairs_j), np.concatenate(dists)
+
+def cluster_labels(n, pairs_i, pairs_j, degree, min_samples):
+    """
+    Etichette DBSCAN (stesse di sklearn) a partire dal grafo dei vicini già filtrato per eps.
+    I cluster sono le componenti connesse dei punti core, numerate in ordine del loro primo punto;
+    un punto di bordo prende l'etichetta più bassa tra quelle dei suoi vicini core.
+    """
+    labels = np.full(n, -1, dtype=int)
+    core = degree >= min_samples
+    if not core.any():
+        return labels
+
+    core_edges = core[pairs_i] & core[pairs_j]
+    graph = coo_matrix(
+        (np.ones(int(core_edges.sum())), (pairs_i[core_edges], pairs_j[core_edges])), shape=(n, n)
+    )
+    _, components = connected_components(graph, directed=False)
+
+    core_idx = np.flatnonzero(core)
+    first_point = np.full(n, n)
+    np.minimum.at(first_point, components[core_idx], core_idx)
+    cluster_components = np.flatnonzero(first_point < n)
+    cluster_components = cluster_components[np.argsort(first_point[cluster_components])]
+    component_to_label = np.full(n, -1, dtype=int)
+    component_to_label[cluster_components] = np.arange(len(cluster_components))
+    labels[core_idx] = component_to_label[components[core_idx]]
+
+    # Punti di bordo: non core ma vicini ad almeno un punto core
+    border_labels = np.full(n, n)
+    for src, dst in ((pairs_i, pairs_j), (pairs_j, pairs_i)):
+        edge = core[src] & ~core[dst]
+        np.minimum.at(border_labels, dst[edge], labels[src[edge]])
+    border = border_labels < n
+    labels[border] = border_labels[border]
+    return labels
 
 def detect_tables_in_sheet(sheet, eps_range=(1.0, 2.0), min_samples_range=(2, 5)):
     """
     rilevamento di tabelle in un singolo foglio Excel.
     Utilizza contenuto, bordi, grassetto e colore di sfondo per l'analisi.
-    Ottimizza i parametri DBSCAN per trovare la configurazione migliore.
+    Ottimizza i parametri DBSCAN per trovare la configurazione migliore: il grafo dei vicini
+    viene calcolato una sola volta e ogni combinazione di parametri ne riusa un sottoinsieme.
     
     Returns:
         tuple: (parametri_ottimali, tutti_risultati)
@@ -19,45 +157,12 @@ def detect_tables_in_sheet(sheet, eps_range=(1.0, 2.0), min_samples_range=(2, 5)
     if max_row == 0 or max_col == 0:
         return None, []
 
-    # Costruisci una matrice di punteggi basata su contenuto, bordi e stile
-    score_matrix = np.zeros((max_row, max_col), dtype=int)
-    for r_idx in range(1, max_row + 1):
-        for c_idx in range(1, max_col + 1):
-            cell = sheet.cell(row=r_idx, column=c_idx)
-            score = 0
-            
-            # Punteggio per il contenuto
-            if cell.value is not None and str(cell.value).strip() != "":
-                score += 1
-            
-            # Punteggio per i bordi
-            if cell.border.left.style: score += 2
-            if cell.border.right.style: score += 2
-            if cell.border.top.style: score += 2
-            if cell.border.bottom.style: score += 2
-            
-            # Punteggio per lo stile del font (es. grassetto)
-            if cell.font and cell.font.bold:
-                score += 3  # Punteggio alto per il grassetto, forte indicatore di intestazione
+    # Coordinate (base 0) e punteggi delle "celle interessanti" (punteggio > 0), in ordine di riga
+    X, _ = extract_cell_scores(sheet)
 
-            # Punteggio per il colore di sfondo (fill)
-            if cell.fill and cell.fill.fill_type and cell.fill.fill_type != 'none':
-                score += 1 # Punteggio più basso, a volte è solo decorativo
-            
-            score_matrix[r_idx-1, c_idx-1] = score
-
-    # Estrai coordinate delle celle con un punteggio > 0 ("celle interessanti")
-    interesting_cells = []
-    for i in range(max_row):
-        for j in range(max_col):
-            if score_matrix[i, j] > 0:
-                interesting_cells.append([i, j])
-    
-    if not interesting_cells:
+    if len(X) == 0:
         return None, []
     
-    X = np.array(interesting_cells)
-    
     # Test sistematico di parametri DBSCAN
     best_params = None
     best_score = float('inf')
@@ -65,22 +170,31 @@ def detect_tables_in_sheet(sheet, eps_range=(1.0, 2.0), min_samples_range=(2, 5)
     
     eps_values = np.arange(eps_range[0], eps_range[1] + 0.1, 0.1)
     min_samples_values = range(min_samples_range[0], min_samples_range[1] + 1)
+
+    n = len(X)
+    all_i, all_j, all_dists = grid_neighbor_pairs(X, max(eps_values))
     
     for eps in eps_values:
+        within_eps = all_dists <= eps
+        pairs_i, pairs_j = all_i[within_eps], all_j[within_eps]
+        # Numero di vicini, incluso il punto stesso (come in DBSCAN)
+        degree = 1 + np.bincount(pairs_i, minlength=n) + np.bincount(pairs_j, minlength=n)
+
         for min_samp in min_samples_values:
-            clustering = DBSCAN(eps=eps, min_samples=min_samp).fit(X)
-            labels = clustering.labels_
+            labels = cluster_labels(n, pairs_i, pairs_j, degree, min_samp)
             
             # Calcola bounding box delle tabelle
             table_bboxes = []
-            for label in set(labels):
-                if label == -1:
-                    continue  # ignora outliers
-                points = X[labels == label]
-                min_row, min_col = points.min(axis=0)
-                max_row, max_col = points.max(axis=0)
-                # Bbox in formato [r0, c0, r1, c1] con indici base 1
-                table_bboxes.append([int(min_row+1), int(min_col+1), int(max_row+1), int(max_col+1)])
+            clustered = labels >= 0  # ignora outliers
+            num_clusters = int(labels.max()) + 1
+            if num_clusters > 0:
+                mins = np.full((num_clusters, 2), np.iinfo(int).max)
+                maxs = np.full((num_clusters, 2), -1)
+                np.minimum.at(mins, labels[clustered], X[clustered])
+                np.maximum.at(maxs, labels[clustered], X[clustered])
+                for (min_row, min_col), (max_row, max_col) in zip(mins, maxs):
+                    # Bbox in formato [r0, c0, r1, c1] con indici base 1
+                    table_bboxes.append([int(min_row+1), int(min_col+1), int(max_row+1), int(max_col+1)])
             
             num_tables = len(table_bboxes)
             num_outliers = np.sum(labels == -1)
@@ -104,20 +218,64 @@ def detect_tables_in_sheet(sheet, eps_range=(1.0, 2.0), min_samples_range=(2, 5)
     
     return best_params, all_results
 
-def analyze_workbook(file_path, eps_range=(1.0, 2.0), min_samples_range=(2, 5), verbose=True):
+def default_cache_dir(db_cache_dir):
+    """ Cartella della cache dei risultati, dentro la cache dei database (fuori dalla cartella del dataset) """
+    return Path(db_cache_dir) / DETECTION_CACHE_DIRNAME
+
+def load_cached_results(cache_path):
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_cached_results(cache_path, results):
+    # scrittura su file temporaneo e rename atomico: più processi possono analizzare lo stesso workbook
+    os.makedirs(cache_path.parent, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(results, f)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+def analyze_workbook(file_path, eps_range=(1.0, 2.0), min_samples_range=(2, 5), verbose=True, cache_dir=None):
     """
     Analizza un intero file Excel (tutti i fogli) e rileva le tabelle.
+    Se `cache_dir` è indicato, i risultati sono salvati su disco con chiave (hash del contenuto, parametri)
+    e riusati nelle esecuzioni successive senza ripetere il rilevamento.
 
     Returns:
         dict con risultati dettagliati per l'intero workbook
     """
-    import json
-    
     if verbose:
         print(f"Analizzando workbook: {file_path}")
-    
+
+    cache_path = None
+    if cache_dir is not None:
+        try:
+            key = workbook_digest(
+                file_path,
+                version=DETECTION_CACHE_VERSION,
+                eps_range=list(eps_range),
+                min_samples_range=list(min_samples_range),
+            )
+        except OSError as e:
+            if verbose:
+                print(f"Errore nell'aprire il file {file_path}: {e}")
+            return None
+        cache_path = Path(cache_dir) / f"{key}.json"
+        cached = load_cached_results(cache_path)
+        if cached is not None:
+            if verbose:
+                print(f"Risultati del rilevamento letti dalla cache: {cache_path}")
+            cached['file_path'] = file_path
+            return cached
+
     try:
-        wb = openpyxl.load_workbook(file_path, data_only=True)
+        wb = load_workbook(file_path, data_only=True)
     except Exception as e:
         if verbose:
             print(f"Errore nell'aprire il file {file_path}: {e}")
@@ -161,4 +319,11 @@ def analyze_workbook(file_path, eps_range=(1.0, 2.0), min_samples_range=(2, 5),
         
         workbook_results['sheets'].append(sheet_summary)
 
+    if cache_path is not None:
+        try:
+            save_cached_results(cache_path, workbook_results)
+        except OSError as e:
+            if verbose:
+                print(f"Impossibile salvare i risultati in cache ({cache_path}): {e}")
+
     return workbook_results
@@ -1,92 +1,60 @@
-import json
+import math
 import re
-from io import StringIO
-from typing import Optional
+from functools import lru_cache
+from typing import List, Optional
 
 import pandas as pd
 import tiktoken
+from pandas.io.parsers import TextParser
 # from recognizers_suite import Culture
 
 from .enumeration import *
 from .exceptions import *
+from .serializers import sqltb2dfloader, sqltb2html, sqltb2json, sqltb2markdown, wtqtb2df
 
 # culture = Culture.English
 
 
-def wtqtb2df(wtq_tb: dict) -> pd.DataFrame:
-    """This function will convert a table dict to a pandas dataframe with correct data type (auto infer)."""
-    header, rows = wtq_tb["header"], wtq_tb["rows"]
-    df = pd.DataFrame(data=rows, columns=header)
-    buffer = StringIO()
-    df.to_csv(buffer, index=False)
-    df_new = pd.read_csv(StringIO(buffer.getvalue()))
-    df_dtype_converted = df_new.convert_dtypes()
-
-    return df_dtype_converted
-
-
-def sqltb2json(wtq_tb: dict, add_row_number: bool, lower_case: bool):
-    df = wtqtb2df(wtq_tb)
-
-    table_json = {}
-    for idx, (_, row) in enumerate(df.iterrows()):
-        row_dict = row.to_dict()
-        if add_row_number:
-            row_number_col = "row number" if lower_case else "Row Number"
-            row_number = row[row_number_col]
-            del row_dict[row_number_col]
-        else:
-            row_number = idx + 1
-        table_json[row_number] = row_dict
-
-    formatted_table_json = "{\n"
-    for k, v in table_json.items():
-        formatted_table_json += f'  "{k}":{json.dumps(v, separators=(",", ":"))},\n'
-    formatted_table_json = formatted_table_json.rstrip(",\n") + "\n}"
-
-    return formatted_table_json
-
-
-def sqltb2markdown(wtq_tb: dict):
-    df = wtqtb2df(wtq_tb)
-
-    return df.to_markdown(index=False)
-
-
-def sqltb2html(wtq_tb: dict):
-    df = wtqtb2df(wtq_tb)
-
-    table_html = df.to_html(index=False, bold_rows=False, border=0, escape=False)
-    # remove style attr
-    table_html = re.sub(r'\s*style\s*=\s*"[^"]*"', "", table_html)
-
-    # remove class attr
-    table_html = re.sub(r'\s*class\s*=\s*"[^"]*"', "", table_html)
-    table_html = re.sub(r"(</th>)\s+(<th>)", r"\1\2", table_html)
-    table_html = re.sub(r"(</td>)\s+(<td>)", r"\1\2", table_html)
-
-    table_html = re.sub(r"(<tr>)\s+(<th>)", r"\1\2", table_html)
-    table_html = re.sub(r"(</th>)\s+(</tr>)", r"\1\2", table_html)
-    table_html = re.sub(r"(<tr>)\s+(<td>)", r"\1\2", table_html)
-    table_html = re.sub(r"(</td>)\s+(</tr>)", r"\1\2", table_html)
-
-    return table_html
-
-
-def sqltb2dfloader(wtq_tb: dict):
-    df = wtqtb2df(wtq_tb)
-
-    col_vals = []
-    for col in df.columns:
-        # print(col)
-        vals = df[col].tolist()
-        # vals = [f"'{val}'" if df[col].dtype == "string[python]" else f"{val}" for val in vals]
-        col_vals.append(f'"{col}": {vals}')
-
-    col_vals = ",\n    ".join(col_vals)
-
-    tb_dfloader = f"pd.DataFrame({{\n    {col_vals}\n}})"
-    return tb_dfloader
+def worksheet2rows(sheet) -> List[list]:
+    """This function will read the cell values of an openpyxl worksheet the same way `pd.read_excel` does.
+    Formula cells are read as empty, as they would be from a file saved by openpyxl (no cached values)."""
+
+    def convert_cell(cell):
+        if cell.value is None or cell.data_type == "f":
+            return ""
+        if cell.data_type == "e":
+            return float("nan")
+        if cell.data_type == "n":
+            val = int(cell.value)
+            return val if val == cell.value else float(cell.value)
+        return cell.value
+
+    if not hasattr(sheet, "_cells"):  # chartsheet
+        return []
+
+    # only the stored cells are read: `iter_rows` would create a cell for every position of the used range
+    values = {}
+    for (row, column), cell in sheet._cells.items():
+        value = convert_cell(cell)
+        if not (isinstance(value, str) and value == ""):
+            values[row, column] = value
+    if not values:
+        return []
+
+    # the rows and columns start at A1, the trailing empty ones are trimmed
+    n_rows = max(row for row, _ in values)
+    n_columns = max(column for _, column in values)
+    rows = [[""] * n_columns for _ in range(n_rows)]
+    for (row, column), value in values.items():
+        rows[row - 1][column - 1] = value
+    return rows
+
+
+def rows2df(rows: List[list]) -> pd.DataFrame:
+    """This function will convert worksheet rows (header first) to a dataframe, with the parser used by `pd.read_excel`."""
+    if len(rows) == 0:
+        return pd.DataFrame()
+    return TextParser(rows, header=0).read()
 
 
 def parse_think(gpt_msg: str) -> str:
@@ -135,16 +103,18 @@ def valid_action(action: str) -> str:
     return action
 
 
+PYTHON_BLOCK_PATTERN = r"```python(.*?)```"
+SELECT_PATTERN = r"\bSELECT\b.*?;"
+
+
 def parse_action_input(gpt_msg, action) -> Optional[str]:
     if action == ACTION.PYTHON_INTERPRETER.value:
-        pattern = r"```python(.*?)```"
-        matches = re.findall(pattern, gpt_msg, re.DOTALL)
+        matches = re.findall(PYTHON_BLOCK_PATTERN, gpt_msg, re.DOTALL)
         if len(matches) != 1:
             raise ActionInputParseError(action)
         return matches[0].strip()
     elif action == ACTION.SHEET_SELECTOR.value:
-        pattern = r"\bSELECT\b.*?;"
-        match = re.search(r"\bSELECT\b.*?;", gpt_msg, re.DOTALL)
+        match = re.search(SELECT_PATTERN, gpt_msg, re.DOTALL)
         if not match:
             raise ActionInputParseError(action)
         return match.group().strip()
@@ -156,6 +126,50 @@ def parse_action_input(gpt_msg, action) -> Optional[str]:
         return match.group(1).strip()
 
 
+class ResponseCutoff:
+    """Watches a streamed response and tells when the rest of it cannot change what the session parses:
+    the response says it is finished ("Done"/"Finish" anywhere), or the first `Action:` line is complete and
+    the first python block / SELECT statement after which the parsers stop has arrived."""
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.action = None
+
+    def feed(self, chunk: str) -> bool:
+        start = max(0, len(self.text) - len("Finish"))
+        self.text += chunk
+        tail = self.text[start:]
+        if "Done" in tail or "Finish" in tail:
+            return True
+
+        if self.action is None:
+            if "\n" not in chunk:
+                return False
+            match = re.search(r"Action:(.+)\n", self.text)
+            if match is None:
+                return False
+            try:
+                self.action = valid_action(match.group(1).strip())
+            except ToolNotFoundError:
+                # not a tool the cutoff knows: the response is read to its end
+                self.action = ""
+                return False
+            return self.input_complete()
+
+        if ("`" in chunk and self.action == ACTION.PYTHON_INTERPRETER.value) or (
+            ";" in chunk and self.action == ACTION.SHEET_SELECTOR.value
+        ):
+            return self.input_complete()
+        return False
+
+    def input_complete(self) -> bool:
+        if self.action == ACTION.PYTHON_INTERPRETER.value:
+            return re.search(PYTHON_BLOCK_PATTERN, self.text, re.DOTALL) is not None
+        if self.action == ACTION.SHEET_SELECTOR.value:
+            return re.search(SELECT_PATTERN, self.text, re.DOTALL) is not None
+        return False  # the answer input runs to the end of the response
+
+
 def parse_answer(gpt_msg):
     pattern = r"Finish:(.+)"
 
@@ -192,23 +206,66 @@ def get_model_token_limit(model: MODEL_TYPE) -> Optional[int]:
     return None
 
 
-def num_tokens_from_messages(msgs, model: MODEL_TYPE):
+@lru_cache(maxsize=None)
+def get_encoding(model: MODEL_TYPE) -> "tiktoken.Encoding":
     try:
-        encoding = tiktoken.encoding_for_model(model.value)
+        return tiktoken.encoding_for_model(model.value)
     except:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
 
-    return count_tokens_openai_chat_models(msgs, encoding)
+def num_tokens_from_messages(msgs, model: MODEL_TYPE):
+    return count_tokens_openai_chat_models(msgs, get_encoding(model))
+
+
+def count_message_tokens(message: dict, encoding) -> int:
+    # message follows <im_start>{role/name}\n{content}<im_end>\n
+    num_tokens = 4
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value or ""))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always 1 token
+    return num_tokens
 
 
 def count_tokens_openai_chat_models(messages, encoding) -> int:
     num_tokens = 0
     for message in messages:
-        # message follows <im_start>{role/name}\n{content}<im_end>\n
-        num_tokens += 4
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tokens += -1  # role is always 1 token
+        num_tokens += count_message_tokens(message, encoding)
     num_tokens += 2  # every reply is primed with <im_start>assistant
     return num_tokens
+
+
+class TokenLedger:
+    """Running token count of a conversation. Each message is encoded once when it is added, so checking the
+    size of the next query only costs the encoding of the new message. When the server reports the prompt size,
+    the local estimate is scaled to match it (other providers may use a different tokenizer)."""
+
+    def __init__(self, model: MODEL_TYPE) -> None:
+        self.encoding = get_encoding(model)
+        self.prefix_tokens = None  # system prompt and few-shot examples, they never change and are counted once
+        self.message_tokens = []
+        self.history_tokens = 0
+        self.usage_ratio = 1.0
+
+    def append(self, message: dict):
+        num_tokens = count_message_tokens(message, self.encoding)
+        self.message_tokens.append(num_tokens)
+        self.history_tokens += num_tokens
+
+    def replace(self, index: int, num_tokens: int):
+        """Update the count of a message of the history, e.g. after it has been shortened."""
+        self.history_tokens += num_tokens - self.message_tokens[index]
+        self.message_tokens[index] = num_tokens
+
+    def local_count(self) -> int:
+        return (self.prefix_tokens or 0) + self.history_tokens + 2
+
+    def estimate(self) -> int:
+        return math.ceil(self.local_count() * self.usage_ratio)
+
+    def calibrate(self, prompt_tokens: Optional[int]):
+        """Align the estimate with the prompt size reported by the server for the query just sent. The estimate
+        is only raised: a server truncating the prompt to its context reports fewer tokens than were sent."""
+        if prompt_tokens:
+            self.usage_ratio = max(1.0, prompt_tokens / self.local_count())
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List
+
+import openpyxl
+
+# parsed workbooks shared by the dataloader, the table detector and the sandbox, keyed by file and mode
+_MAX_CACHED = 4
+_cache: "OrderedDict[tuple, openpyxl.Workbook]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _cache_key(workbook_path, data_only: bool) -> tuple:
+    path = Path(workbook_path).resolve()
+    stat = path.stat()
+    return (str(path), stat.st_mtime_ns, stat.st_size, data_only)
+
+
+def load_workbook(workbook_path, data_only: bool = False) -> openpyxl.Workbook:
+    """Parse the workbook once per mode and share the result. Callers must not modify the returned workbook."""
+    key = _cache_key(workbook_path, data_only)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    workbook = openpyxl.load_workbook(workbook_path, data_only=data_only)
+    with _lock:
+        _cache[key] = workbook
+        while len(_cache) > _MAX_CACHED:
+            _cache.popitem(last=False)
+    return workbook
+
+
+def take_workbook(workbook_path, data_only: bool = False) -> openpyxl.Workbook:
+    """Like `load_workbook`, but the caller takes ownership: the workbook is removed from the cache and may be modified."""
+    key = _cache_key(workbook_path, data_only)
+    with _lock:
+        workbook = _cache.pop(key, None)
+    if workbook is None:
+        workbook = openpyxl.load_workbook(workbook_path, data_only=data_only)
+    return workbook
+
+
+def sheet_names(workbook_path) -> List[str]:
+    """Names of the sheets, read without parsing the sheets themselves."""
+    workbook = openpyxl.load_workbook(workbook_path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def workbook_digest(workbook_path, **options) -> str:
+    """Hash of the workbook content together with the options used to process it."""
+    digest = hashlib.sha256()
+    with open(workbook_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()